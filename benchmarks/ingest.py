@@ -0,0 +1,88 @@
+"""
+Сравнение скорости сохранения сообщений в SQLite: ORM-объекты и `bulk_save_objects` с
+настройками SQLite по умолчанию против быстрой вставки (`database.insert`) с настройками
+для массовой вставки (`database.connect(..., ingest=True)`)
+
+Запуск из корня репозитория:
+    python benchmarks/ingest.py [-n MESSAGES]
+"""
+import random
+import sys
+from argparse import ArgumentParser
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from vkms import database as db  # noqa: E402
+
+
+def gen_pages(count):
+    # Генерирует страницы по 200 сообщений, похожие на ответы `messages.getHistory`
+    rnd = random.Random(0)
+    words = ['привет', 'как', 'дела', 'hello', 'ok', 'норм', 'завтра', 'увидимся', 'лол']
+    date = 1600000000
+
+    for start in range(1, count + 1, 200):
+        page = []
+
+        for msg_id in range(start, min(start + 200, count + 1)):
+            date += rnd.randint(1, 600)
+            page.append({
+                'id': msg_id,
+                'date': date,
+                'from_id': rnd.choice((1, 2, 3, -4)),
+                'peer_id': 2000000001,
+                'text': ' '.join(rnd.choice(words) for _ in range(rnd.randint(1, 40))),
+                'attachments': [],
+                'fwd_messages': [],
+                'conversation_message_id': msg_id,
+                'out': rnd.randint(0, 1)
+            })
+
+        yield page
+
+
+def run(path, pages, fast):
+    session = db.connect(path, ingest=fast)
+    started = perf_counter()
+    saved = 0
+
+    for page in pages:
+        if fast:
+            db.insert(session, db.Message, page)
+        else:
+            session.bulk_save_objects([db.Message(json=msg_json) for msg_json in page])
+
+        saved += len(page)
+
+        # Как и при загрузке, фиксируем транзакцию каждые 5000 сообщений
+        if saved % 5000 == 0:
+            session.commit()
+
+    session.commit()
+    elapsed = perf_counter() - started
+    session.close()
+
+    return saved / elapsed
+
+
+def main():
+    parser = ArgumentParser(description='SQLite ingest benchmark')
+    parser.add_argument('-n', type=int, default=200000, help='Number of messages')
+    args = parser.parse_args()
+
+    pages = list(gen_pages(args.n))
+
+    with TemporaryDirectory() as tmp:
+        before = run(Path(tmp) / 'before.sqlite', pages, False)
+        after = run(Path(tmp) / 'after.sqlite', pages, True)
+
+    print(f'ORM bulk_save_objects, default pragmas: {before:10.0f} rows/s')
+    print(f'Core executemany, ingest pragmas:       {after:10.0f} rows/s')
+    print(f'Speedup: x{after / before:.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+import asyncio
+import threading
+
+import pytest
+from fakes import FakeVK
+from vk.exceptions import VkAPIError
+
+
+@pytest.fixture
+def vk_server():
+    """
+    Запускает локальный HTTP-сервер VK API (aiohttp) в отдельном потоке. Возвращает
+    `FakeVK`, данные которого можно менять во время теста, и адрес методов
+    """
+    web = pytest.importorskip('aiohttp.web')
+    vk = FakeVK({})
+
+    async def handle(request):
+        params = dict(await request.post())
+
+        try:
+            result = vk.call(request.match_info['method'], params)
+        except VkAPIError as e:
+            return web.json_response({'error': {
+                'error_code': e.code, 'error_msg': e.message, 'request_params': []
+            }})
+
+        return web.json_response({'response': result})
+
+    app = web.Application()
+    app.router.add_post('/method/{method}', handle)
+
+    loop = asyncio.new_event_loop()
+    runner = web.AppRunner(app)
+    loop.run_until_complete(runner.setup())
+
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    loop.run_until_complete(site.start())
+    port = runner.addresses[0][1]
+
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+
+    yield vk, f'http://127.0.0.1:{port}/method/'
+
+    asyncio.run_coroutine_threadsafe(runner.cleanup(), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    loop.close()
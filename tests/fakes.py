@@ -0,0 +1,148 @@
+"""
+Имитация VK API для тестов
+"""
+import json
+import re
+
+from vk.exceptions import VkAPIError
+
+ACCOUNT = {'id': 1, 'first_name': 'Account', 'last_name': 'Owner'}
+
+
+def make_msg(peer_id, msg_id, from_id=None):
+    return {
+        'id': msg_id,
+        'date': 1600000000 + msg_id * 60,
+        'from_id': from_id or 1 + msg_id % 3,
+        'peer_id': peer_id,
+        'text': f'message {msg_id}',
+        'attachments': [],
+        'fwd_messages': [],
+        'conversation_message_id': msg_id,
+        'out': 0
+    }
+
+
+class FakeVK:
+    """
+    Данные и методы VK API для тестов: переписки с сообщениями, пользователи и группы
+
+    Args:
+        peers (dict): Сообщения (от старых к новым) каждой переписки
+    """
+
+    def __init__(self, peers):
+        self.peers = peers
+
+        # Вызовы методов (название и параметры) в порядке поступления
+        self.calls = []
+
+        # Функция, которая вызывается перед каждым методом и может выбросить ошибку
+        self.fail = None
+
+    def call(self, method, params):
+        self.calls.append((method, params))
+
+        if self.fail is not None:
+            self.fail(method, params)
+
+        if method == 'execute':
+            return self.execute(params['code'])
+
+        return getattr(self, method.replace('.', '_'))(params)
+
+    def execute(self, code):
+        results = []
+
+        for method, params in re.findall(r'API\.([\w.]+)\((\{.*?\})\)', code):
+            try:
+                results.append(self.call(method, json.loads(params)))
+            except VkAPIError:
+                results.append(False)
+
+        return results
+
+    def users_get(self, params):
+        if 'user_ids' not in params:
+            return [ACCOUNT]
+
+        return [
+            {'id': int(id), 'first_name': f'User{id}', 'last_name': 'Test'}
+            for id in str(params['user_ids']).split(',')
+        ]
+
+    def groups_getById(self, params):  # noqa: N802
+        return [
+            {'id': int(id), 'name': f'Group{id}', 'screen_name': f'club{id}'}
+            for id in str(params['group_ids']).split(',')
+        ]
+
+    def messages_getConversations(self, params):  # noqa: N802
+        offset, count = int(params.get('offset', 0)), int(params['count'])
+        peer_ids = sorted(self.peers)[offset:offset + count]
+
+        return {
+            'count': len(self.peers),
+            'items': [{'conversation': self.conversation(peer_id)} for peer_id in peer_ids],
+            'profiles': [ACCOUNT]
+        }
+
+    def messages_getHistory(self, params):  # noqa: N802
+        msgs = self.peers[int(params['peer_id'])]
+        offset, count = int(params.get('offset', 0)), int(params['count'])
+
+        if 'start_message_id' in params:
+            # Отрицательное смещение - сообщения новее указанного (от новых к старым)
+            desc = msgs[::-1]
+            start = next(
+                i for i, msg in enumerate(desc) if msg['id'] == int(params['start_message_id'])
+            )
+            items = desc[max(start + offset, 0):max(start + offset + count, 0)]
+
+        elif int(params.get('rev', 0)):
+            items = msgs[offset:offset + count]
+
+        else:
+            items = msgs[::-1][offset:offset + count]
+
+        return {'count': len(msgs), 'items': json.loads(json.dumps(items))}
+
+    def conversation(self, peer_id):
+        msgs = self.peers[peer_id]
+
+        return {
+            'peer': {'id': peer_id, 'type': 'chat' if peer_id > 2000000000 else 'user'},
+            'chat_settings': {'title': f'Chat {peer_id}'},
+            'last_message_id': msgs[-1]['id'] if msgs else 0
+        }
+
+
+class FakeAPI:
+    """
+    Синхронный объект VK API (аналог `vk.API`), методы которого выполняет `FakeVK`
+    """
+
+    def __init__(self, vk):
+        self._vk = vk
+
+    def __call__(self, method):
+        return lambda **params: self._vk.call(method, params)
+
+    def __getattr__(self, name):
+        if name == 'execute':
+            return self('execute')
+
+        return _Group(self, name)
+
+
+class _Group:
+    def __init__(self, api, name):
+        self._api = api
+        self._name = name
+
+    def __getattr__(self, name):
+        return self._api(f'{self._name}.{name}')
+
+
+def api_error(code):
+    return VkAPIError({'error_code': code, 'error_msg': 'Test error', 'request_params': []})
@@ -0,0 +1,523 @@
+import shutil
+import sqlite3
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+
+import pytest
+from fakes import ACCOUNT, FakeAPI, FakeVK, api_error, make_msg
+
+from vkms import actions
+from vkms import database as db
+from vkms import saver, users
+
+PEER_ID = 2000000001
+
+
+@pytest.fixture
+def out_dir(tmp_path):
+    (tmp_path / '.sqlite').mkdir()
+    (tmp_path / '.state').mkdir()
+    return tmp_path
+
+
+@pytest.fixture
+def executor():
+    with ThreadPoolExecutor(4) as executor:
+        yield executor
+
+
+def dump_peer(out_dir, vk, executor, append=False):
+    # Загружает переписку так же, как `actions.dump` для одной переписки
+    return actions._dump_peer(
+        out_dir,
+        FakeAPI(vk),
+        executor,
+        4,
+        False,
+        users.Cache(out_dir / '.state/profiles.sqlite', 7),
+        ACCOUNT,
+        vk.conversation(PEER_ID),
+        float('inf'),
+        append,
+        False,
+        False
+    )
+
+
+def saved_ids(out_dir):
+    session = db.connect(out_dir / f'.sqlite/{PEER_ID}.sqlite')
+    ids = [id for id, in session.query(db.Message.id).order_by(db.Message.id)]
+    progress = session.get(db.Progress, PEER_ID)
+
+    session.close()
+    session.get_bind().dispose()
+
+    return ids, progress
+
+
+def history_offsets(vk):
+    # Смещения запросов страниц сообщений (без запроса кол-ва сообщений)
+    return [
+        params['offset'] for method, params in vk.calls
+        if method == 'messages.getHistory' and 'offset' in params
+    ]
+
+
+def test_dump_peer(out_dir, executor):
+    vk = FakeVK({PEER_ID: [make_msg(PEER_ID, i) for i in range(1, 1001)]})
+
+    assert dump_peer(out_dir, vk, executor) == 1000
+
+    ids, progress = saved_ids(out_dir)
+    assert ids == list(range(1, 1001))
+    assert progress is None
+
+
+def test_dump_peer_skips_malformed_attachments(out_dir, executor):
+    msgs = [make_msg(PEER_ID, i) for i in range(1, 4)]
+    msgs[0]['attachments'] = [{'type': 'photo', 'photo': {'id': 1}}, {'type': 'doc'}]
+    msgs[1]['attachments'] = [{'type': 'photo', 'photo': {
+        'id': 2, 'owner_id': 7, 'sizes': [{'width': 1, 'height': 1, 'url': 'https://a/2.jpg'}]
+    }}]
+    vk = FakeVK({PEER_ID: msgs})
+
+    # Вложения без обязательных полей пропускаются, остальные индексируются
+    assert dump_peer(out_dir, vk, executor) == 3
+
+    session = db.connect(out_dir / f'.sqlite/{PEER_ID}.sqlite')
+    assert session.query(db.Attachment.msg_id, db.Attachment.filename).all() == [(2, '7_2.jpg')]
+
+
+def test_dump_peer_does_not_migrate_replaced_db(out_dir, executor, monkeypatch):
+    # БД предыдущей версии, которую повторная загрузка заменяет
+    conn = sqlite3.connect(out_dir / f'.sqlite/{PEER_ID}.sqlite')
+    conn.execute('CREATE TABLE messages (id INTEGER PRIMARY KEY, json JSON, date DATETIME)')
+    conn.execute("INSERT INTO messages VALUES (1, '{}', '2020-01-01 00:00:00')")
+    conn.commit()
+    conn.close()
+
+    migrated = []
+    migrate = db._migrate
+
+    def spy(engine):
+        with engine.connect() as conn:
+            migrated.append(conn.exec_driver_sql('SELECT count(*) FROM messages').scalar())
+
+        migrate(engine)
+
+    monkeypatch.setattr(db, '_migrate', spy)
+
+    # Миграции применяются только к новой (пустой) БД
+    assert dump_peer(out_dir, FakeVK({PEER_ID: [make_msg(PEER_ID, 1)]}), executor) == 1
+    assert migrated == [0]
+
+
+def test_dump_peer_resumes_from_checkpoint(out_dir, executor):
+    vk = FakeVK({PEER_ID: [make_msg(PEER_ID, i) for i in range(1, 12001)]})
+
+    def fail(method, params):
+        if method == 'messages.getHistory' and params.get('offset', 0) >= 7000:
+            raise api_error(10)
+
+    # Загрузка прерывается после первой контрольной точки (каждые 5000 сообщений)
+    vk.fail = fail
+    assert dump_peer(out_dir, vk, executor) is None
+
+    ids, progress = saved_ids(out_dir)
+    assert ids == list(range(1, 5001))
+    assert (progress.offset, progress.count, progress.done) == (0, 12000, 5000)
+
+    # Повторная загрузка продолжается с контрольной точки
+    vk.fail = None
+    vk.calls.clear()
+    assert dump_peer(out_dir, vk, executor) == 12000
+
+    ids, progress = saved_ids(out_dir)
+    assert ids == list(range(1, 12001))
+    assert progress is None
+    assert min(history_offsets(vk)) == 5000
+
+
+def test_dump_skips_peer_with_unexpected_error(out_dir, monkeypatch):
+    vk = FakeVK({
+        PEER_ID: [make_msg(PEER_ID, i) for i in range(1, 301)],
+        PEER_ID + 1: [make_msg(PEER_ID + 1, i) for i in range(1, 301)]
+    })
+
+    def fail(method, params):
+        if method == 'messages.getHistory' and params['peer_id'] == PEER_ID + 1:
+            raise KeyError('items')
+
+    vk.fail = fail
+    monkeypatch.setattr(actions, 'API', lambda **kwargs: FakeAPI(vk))  # noqa: U100
+
+    actions.dump(
+        out_dir, set(), set(), 'token', 'threads', 2, 1000, False, 7, float('inf'), False,
+        False, False
+    )
+
+    # Ошибка в одной переписке не мешает загрузке другой и не повторяется
+    assert saved_ids(out_dir)[0] == list(range(1, 301))
+
+    state = db.connect(out_dir / '.state/peers.sqlite', db.StateBase)
+    assert dict(state.query(db.PeerState.id, db.PeerState.last_msg_id)) == {PEER_ID: 300}
+
+    failed_calls = [
+        params for method, params in vk.calls
+        if method == 'messages.getHistory' and params['peer_id'] == PEER_ID + 1
+    ]
+    assert len(failed_calls) == 1
+
+
+def test_dump_peer_append_fetches_only_new_messages(out_dir, executor, caplog):
+    vk = FakeVK({PEER_ID: [make_msg(PEER_ID, i) for i in range(1, 1001)]})
+    dump_peer(out_dir, vk, executor)
+
+    vk.peers[PEER_ID] += [make_msg(PEER_ID, i) for i in range(1001, 1251)]
+    vk.calls.clear()
+
+    with caplog.at_level('INFO', logger='vkms'):
+        assert dump_peer(out_dir, vk, executor, append=True) == 1250
+
+    assert saved_ids(out_dir)[0] == list(range(1, 1251))
+
+    # Сначала отправляется один запрос, и окно растет, только пока страницы полные
+    assert sorted(history_offsets(vk)) == [-600, -400, -200]
+    assert f'Appended 250 new messages to peer {PEER_ID}' in caplog.text
+
+
+def test_dump_peer_append_after_deleted_messages(out_dir, executor):
+    vk = FakeVK({PEER_ID: [make_msg(PEER_ID, i) for i in range(1, 1001)]})
+    dump_peer(out_dir, vk, executor)
+
+    # Часть сохраненных сообщений удалена из переписки, и появились новые
+    del vk.peers[PEER_ID][100:110]
+    vk.peers[PEER_ID] += [make_msg(PEER_ID, i) for i in range(1001, 1051)]
+
+    assert dump_peer(out_dir, vk, executor, append=True) == 1050
+    assert saved_ids(out_dir)[0] == list(range(1, 1051))
+
+    # Если новых сообщений нет, достаточно одного запроса
+    vk.calls.clear()
+    assert dump_peer(out_dir, vk, executor, append=True) == 1050
+    assert len(history_offsets(vk)) == 1
+
+
+def test_search_interleaves_peers(out_dir, monkeypatch, capsys):
+    vk = FakeVK({
+        PEER_ID: [make_msg(PEER_ID, i) for i in range(1, 11)],
+        PEER_ID + 1: [make_msg(PEER_ID + 1, i) for i in range(1, 11)]
+    })
+
+    # В первой переписке слово редкое, поэтому bm25 ее результатов намного лучше, чем у
+    # второй переписки, где слово есть в каждом сообщении
+    for msg in vk.peers[PEER_ID][:2]:
+        msg['text'] = 'найди найди найди'
+
+    for msg in vk.peers[PEER_ID + 1]:
+        msg['text'] = 'найди это сообщение среди длинного текста без повторов'
+
+    monkeypatch.setattr(actions, 'API', lambda **kwargs: FakeAPI(vk))  # noqa: U100
+    actions.dump(
+        out_dir, set(), set(), 'token', 'threads', 2, 1000, False, 7, float('inf'), False,
+        False, False
+    )
+    capsys.readouterr()
+
+    actions.search(out_dir, set(), set(), 'найди', 2)
+
+    # Лучший результат каждой переписки выводится раньше остальных результатов
+    lines = capsys.readouterr().out.splitlines()
+    assert len(lines) == 2
+    assert any(f'({PEER_ID})' in line for line in lines)
+    assert any(f'({PEER_ID + 1})' in line for line in lines)
+
+
+def test_dump_several_peers(out_dir, monkeypatch):
+    vk = FakeVK({
+        peer_id: [make_msg(peer_id, i) for i in range(1, 301 + peer_id % 10 * 100)]
+        for peer_id in (PEER_ID, PEER_ID + 1, 2, 3)
+    })
+    monkeypatch.setattr(actions, 'API', lambda **kwargs: FakeAPI(vk))  # noqa: U100
+
+    # Переписки загружаются одновременно в двух потоках
+    actions.dump(
+        out_dir, set(), set(), 'token', 'threads', 2, 1000, False, 7, float('inf'), False,
+        False, False
+    )
+
+    for peer_id, msgs in vk.peers.items():
+        session = db.connect(out_dir / f'.sqlite/{peer_id}.sqlite')
+        assert session.query(db.Message.id).order_by(db.Message.id).all() == [
+            (msg['id'],) for msg in msgs
+        ]
+
+        session.close()
+        session.get_bind().dispose()
+
+    state = db.connect(out_dir / '.state/peers.sqlite', db.StateBase)
+    assert dict(state.query(db.PeerState.id, db.PeerState.last_msg_id)) == {
+        peer_id: msgs[-1]['id'] for peer_id, msgs in vk.peers.items()
+    }
+
+
+def test_atch_and_parse_close_peer_dbs(out_dir, monkeypatch):
+    vk = FakeVK({peer_id: [make_msg(peer_id, 1)] for peer_id in (PEER_ID, 2)})
+    monkeypatch.setattr(actions, 'API', lambda **kwargs: FakeAPI(vk))  # noqa: U100
+    actions.dump(
+        out_dir, set(), set(), 'token', 'threads', 2, 1000, False, 7, float('inf'), False,
+        False, False
+    )
+
+    closed = []
+    close_peer = actions._close_peer
+
+    def spy(session):
+        closed.append(session)
+        close_peer(session)
+
+    monkeypatch.setattr(actions, '_close_peer', spy)
+
+    # БД каждой переписки закрывается после загрузки вложений и после сохранения
+    actions.atch(out_dir, set(), set(), 'threads', 2, {'photos'}, False, False)
+    assert len(closed) == 2
+
+    closed.clear()
+    actions._parse_peer(out_dir, 'txt', PEER_ID, None)
+    assert len(closed) == 1
+
+
+def finished(result=None, error=None):
+    future = Future()
+
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+
+    return future
+
+
+def test_peer_results_retry_policy(out_dir):
+    state = db.connect(out_dir / '.state/peers.sqlite', db.StateBase)
+    results = actions._PeerResults(state, [1, 2, 3])
+
+    # Загрузка, завершившаяся без результата, повторяется не более 3 раз
+    assert [results.add(1, finished()) for _ in range(3)] == [True, True, False]
+
+    # Непредвиденная ошибка не повторяется, а успешная загрузка сохраняется в состоянии
+    assert not results.add(2, finished(error=KeyError('items')))
+    assert not results.add(3, finished(42))
+
+    assert results.failed == [1, 2]
+    assert dict(state.query(db.PeerState.id, db.PeerState.last_msg_id)) == {3: 42}
+
+
+def test_parse_peer_minifies_html_in_parts(out_dir, executor, monkeypatch):
+    vk = FakeVK({PEER_ID: [make_msg(PEER_ID, i) for i in range(1, 301)]})
+    dump_peer(out_dir, vk, executor)
+
+    pages = []
+    write_minified = saver._write_minified
+
+    def spy(file, chunks):
+        # Сжимаем документ маленькими частями и запоминаем результат сжатия целиком
+        chunks = list(chunks)
+        pages.append(saver._minify(''.join(chunks)))
+        write_minified(file, chunks, buffer_size=1000)
+
+    monkeypatch.setattr(saver, '_write_minified', spy)
+
+    path = actions._parse_peer(out_dir, 'html', PEER_ID, None)
+    assert path.read_text(encoding='utf-8') == pages[0]
+
+
+def test_parse_peer_paginates_html(out_dir, executor):
+    msgs = [make_msg(PEER_ID, i) for i in range(1, 251)]
+    msgs[240]['reply_message'] = make_msg(PEER_ID, 5)
+    msgs[241]['reply_message'] = make_msg(PEER_ID, 230)
+    vk = FakeVK({PEER_ID: msgs})
+    dump_peer(out_dir, vk, executor)
+
+    path = actions._parse_peer(out_dir, 'html', PEER_ID, 100)
+    assert sorted(file.name for file in path.parent.iterdir()) == [
+        '1.html', '2.html', '3.html', 'index.html'
+    ]
+
+    # Ответ на сообщение с другой страницы ссылается на эту страницу, а с той же -
+    # прокручивает текущую
+    page = (path.parent / '3.html').read_text(encoding='utf-8')
+    assert "location.href = '1.html#5'" in page
+    assert "scroll_to_message('230')" in page
+
+    # При другом разбиении лишние страницы удаляются
+    actions._parse_peer(out_dir, 'html', PEER_ID, 200)
+    assert sorted(file.name for file in path.parent.iterdir()) == [
+        '1.html', '2.html', 'index.html'
+    ]
+
+
+def test_parse_skips_unchanged_peers(out_dir, executor, tmp_path_factory, monkeypatch):
+    vk = FakeVK({PEER_ID: [make_msg(PEER_ID, i) for i in range(1, 11)]})
+    dump_peer(out_dir, vk, executor)
+
+    rendered = []
+    parse_peer = actions._parse_peer
+
+    def spy(out_dir, fmt, peer_id, paginate):
+        rendered.append(peer_id)
+        return parse_peer(out_dir, fmt, peer_id, paginate)
+
+    monkeypatch.setattr(actions, '_parse_peer', spy)
+
+    def parse():
+        rendered.clear()
+        actions.parse(out_dir, set(), set(), 'html', 1, None)
+        return rendered
+
+    assert parse() == [PEER_ID]
+    assert parse() == []
+
+    # Изменение переписки
+    vk.peers[PEER_ID].append(make_msg(PEER_ID, 11))
+    dump_peer(out_dir, vk, executor, append=True)
+    assert parse() == [PEER_ID]
+    assert parse() == []
+
+    # Изменение шаблонов (копия пакета с измененными стилями)
+    package_dir = tmp_path_factory.mktemp('vkms')
+    shutil.copytree(Path(saver.__file__).parent / 'templates', package_dir / 'templates')
+    (package_dir / 'templates/style.css').write_text('body {}', encoding='utf-8')
+    monkeypatch.setattr(saver, '__file__', str(package_dir / 'saver.py'))
+    assert parse() == [PEER_ID]
+    assert parse() == []
+
+    # Удаление сохраненного файла
+    for path in out_dir.glob('dialogs/html/*.html'):
+        path.unlink()
+
+    assert parse() == [PEER_ID]
+
+
+def test_dump_append_skips_unchanged_peers(out_dir, monkeypatch):
+    vk = FakeVK({peer_id: [make_msg(peer_id, i) for i in range(1, 11)] for peer_id in (PEER_ID, 2)})
+    monkeypatch.setattr(actions, 'API', lambda **kwargs: FakeAPI(vk))  # noqa: U100
+
+    def dump():
+        vk.calls.clear()
+        actions.dump(
+            out_dir, set(), set(), 'token', 'threads', 2, 1000, False, 7, float('inf'), True,
+            False, False
+        )
+        return {params['peer_id'] for method, params in vk.calls if 'peer_id' in params}
+
+    assert dump() == {PEER_ID, 2}
+
+    # Если в переписке не появилось новых сообщений, для нее не вызывается ни один метод
+    vk.peers[2].append(make_msg(2, 11))
+    assert dump() == {2}
+    assert dump() == set()
+    assert {method for method, _ in vk.calls} == {'users.get', 'messages.getConversations'}
+
+
+def test_profiles_cache_ttl(out_dir):
+    path = out_dir / '.state/profiles.sqlite'
+    profile = {'id': 2, 'first_name': 'User2', 'last_name': 'Test'}
+    group = {'id': 3, 'name': 'Group3', 'screen_name': 'club3'}
+
+    users.Cache(path, 7).put([profile, group])
+
+    # Группы хранятся с отрицательными идентификаторами
+    assert sorted(users.Cache(path, 7).get({2, -3, 4}), key=str) == [profile, group]
+
+    # Устаревшая информация не возвращается, а сохраненная в этом запуске - актуальна
+    cache = users.Cache(path, 0)
+    assert cache.get({2, -3}) == []
+
+    cache.put([profile])
+    assert cache.get({2, -3}) == [profile]
+
+
+def test_dump_takes_profiles_from_cache(out_dir, monkeypatch):
+    vk = FakeVK({PEER_ID: [make_msg(PEER_ID, i) for i in range(1, 11)]})
+    monkeypatch.setattr(actions, 'API', lambda **kwargs: FakeAPI(vk))  # noqa: U100
+
+    def dump(profiles_ttl):
+        vk.calls.clear()
+        (out_dir / f'.sqlite/{PEER_ID}.sqlite').unlink(missing_ok=True)
+        actions.dump(
+            out_dir, set(), set(), 'token', 'threads', 2, 1000, False, profiles_ttl,
+            float('inf'), False, False, False
+        )
+        return [params for method, params in vk.calls if method == 'users.get']
+
+    assert dump(7) == [{}, {'user_ids': '2,3'}]
+
+    # Участники загружаются заново, только когда информация о них устарела
+    assert dump(7) == [{}]
+    assert dump(0) == [{}, {'user_ids': '2,3'}]
+
+
+def test_dump_takes_profiles_from_conversations(out_dir, monkeypatch):
+    vk = FakeVK({PEER_ID: [make_msg(PEER_ID, 1), make_msg(PEER_ID, 2), make_msg(PEER_ID, 3, -5)]})
+    get_conversations = vk.messages_getConversations
+
+    def extended(params):
+        # Вместе с переписками VK API возвращает их участников
+        res = get_conversations(params)
+        res['profiles'] += [
+            {'id': id, 'first_name': f'Member{id}', 'last_name': ''} for id in (2, 3)
+        ]
+        res['groups'] = [{'id': 5, 'name': 'Group5', 'screen_name': 'club5'}]
+        return res
+
+    vk.messages_getConversations = extended
+    monkeypatch.setattr(actions, 'API', lambda **kwargs: FakeAPI(vk))  # noqa: U100
+
+    actions.dump(
+        out_dir, set(), set(), 'token', 'threads', 2, 1000, False, 7, float('inf'), False,
+        False, False
+    )
+
+    # Участники не загружаются отдельно (загружается только владелец аккаунта)
+    assert [params for method, params in vk.calls if method == 'users.get'] == [{}]
+    assert 'groups.getById' not in {method for method, _ in vk.calls}
+
+    session = db.connect(out_dir / f'.sqlite/{PEER_ID}.sqlite')
+    assert users.parse(session) == {2: 'Member2 ', 3: 'Member3 ', -5: 'Group5'}
+
+    session.close()
+    session.get_bind().dispose()
+
+
+def test_parse_writes_assets_once(out_dir, monkeypatch):
+    vk = FakeVK({peer_id: [make_msg(peer_id, 1)] for peer_id in (PEER_ID, 2)})
+    monkeypatch.setattr(actions, 'API', lambda **kwargs: FakeAPI(vk))  # noqa: U100
+    actions.dump(
+        out_dir, set(), set(), 'token', 'threads', 2, 1000, False, 7, float('inf'), False,
+        False, False
+    )
+
+    written = []
+    save_assets = saver.save_assets
+
+    def spy(out_dir):
+        written.append(out_dir)
+        save_assets(out_dir)
+
+    monkeypatch.setattr(saver, 'save_assets', spy)
+    actions.parse(out_dir, set(), set(), 'html', 1, None)
+    assert written == [out_dir]
+
+    assets_dir = out_dir / 'dialogs/html/assets'
+    assert sorted(path.name for path in assets_dir.iterdir()) == ['script.js', 'style.css']
+
+    # Страницы переписок ссылаются на общие стили и скрипты, а не содержат их
+    pages = list(out_dir.glob('dialogs/html/*.html'))
+    assert len(pages) == 2
+
+    for path in pages:
+        page = path.read_text(encoding='utf-8')
+
+        assert 'href=assets/style.css' in page and 'src=assets/script.js' in page
+        assert '<style' not in page
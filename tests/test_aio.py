@@ -0,0 +1,91 @@
+from functools import partial
+
+import pytest
+from fakes import make_msg
+
+from vkms import actions
+from vkms import database as db
+from vkms.api import API
+
+aio = pytest.importorskip('vkms.aio')
+
+
+def make_peers():
+    # Беседа с участием группы, ответами и пересланными сообщениями и две переписки
+    # с пользователями
+    chat = [make_msg(2000000001, i, from_id=-5 if i % 7 == 0 else None) for i in range(1, 1301)]
+
+    for msg in chat[10::50]:
+        msg['reply_message'] = make_msg(2000000001, msg['id'] - 1, from_id=42)
+
+    for msg in chat[20::50]:
+        msg['fwd_messages'] = [make_msg(2000000001, 0, from_id=43)]
+
+    return {
+        2000000001: chat,
+        2: [make_msg(2, i, from_id=2 if i % 2 else 1) for i in range(1, 451)],
+        3: [make_msg(3, i, from_id=3) for i in range(1, 6)]
+    }
+
+
+def snapshot(out_dir):
+    # Содержимое всех БД переписок и состояние синхронизации
+    result = {}
+
+    for path in sorted(out_dir.glob('.sqlite/*.sqlite')):
+        session = db.connect(path)
+        sync = session.query(db.SyncInfo).one()
+
+        result[path.name] = (
+            session.query(db.Message.id, db.Message.json).order_by(db.Message.id).all(),
+            session.query(db.User.id, db.User.json).order_by(db.User.id).all(),
+            (sync.last_msg_id, sync.msg_count),
+            session.query(db.Progress).count()
+        )
+
+        session.close()
+        session.get_bind().dispose()
+
+    state = db.connect(out_dir / '.state/peers.sqlite', db.StateBase)
+    result['state'] = sorted(state.query(db.PeerState.id, db.PeerState.last_msg_id))
+
+    return result
+
+
+def dump(out_dir, engine, execute, append=False):
+    (out_dir / '.sqlite').mkdir(parents=True, exist_ok=True)
+    (out_dir / '.state').mkdir(exist_ok=True)
+
+    actions.dump(
+        out_dir, set(), set(), 'token', engine, 4, 1000, execute, 7, float('inf'), append,
+        False, False
+    )
+
+
+@pytest.mark.parametrize('execute', (False, True))
+def test_async_engine_matches_threads(tmp_path, monkeypatch, vk_server, execute):
+    vk, url = vk_server
+    vk.peers = make_peers()
+
+    # Оба движка обращаются к локальному серверу
+    monkeypatch.setattr(API, 'API_URL', url)
+    monkeypatch.setattr(aio, 'AsyncAPI', partial(aio.AsyncAPI, api_url=url))
+
+    dump(tmp_path / 'threads', 'threads', execute)
+    dump(tmp_path / 'asyncio', 'asyncio', execute)
+
+    expected = snapshot(tmp_path / 'threads')
+
+    assert len(expected['2000000001.sqlite'][0]) == 1300
+    assert snapshot(tmp_path / 'asyncio') == expected
+
+    # Дозапись новых сообщений тоже дает одинаковый результат
+    vk.peers[2] += [make_msg(2, i, from_id=2) for i in range(451, 700)]
+
+    dump(tmp_path / 'threads', 'threads', execute, append=True)
+    dump(tmp_path / 'asyncio', 'asyncio', execute, append=True)
+
+    expected = snapshot(tmp_path / 'threads')
+
+    assert len(expected['2.sqlite'][0]) == 699
+    assert snapshot(tmp_path / 'asyncio') == expected
@@ -0,0 +1,132 @@
+import re
+
+import pytest
+from vk.exceptions import VkAPIError
+
+from vkms import api as vkms_api
+from vkms.api import RateLimiter, _execute, execute_code
+
+
+class Clock:
+    # Подменяет `monotonic`, чтобы время в тестах шло только вручную
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(vkms_api, 'monotonic', clock)
+    return clock
+
+
+def test_rate_limiter_spreads_requests(clock):
+    limiter = RateLimiter(4)
+
+    # Первый запрос отправляется сразу, следующие встают в очередь через 1 / rate
+    assert limiter.reserve() == pytest.approx(0)
+    assert limiter.reserve() == pytest.approx(0.25)
+    assert limiter.reserve() == pytest.approx(0.5)
+
+    # Спустя время очередь пуста, но в корзине не больше одного токена
+    clock.now += 10
+    assert limiter.reserve() == pytest.approx(0)
+    assert limiter.reserve() == pytest.approx(0.25)
+
+
+def test_rate_limiter_rejects_non_positive_rate():
+    for rate in (0, -1):
+        with pytest.raises(ValueError):
+            RateLimiter(rate)
+
+
+def test_rate_limiter_slow_down_and_recovery(clock):
+    limiter = RateLimiter(10)
+
+    limiter.slow_down()
+    assert limiter.rate == pytest.approx(5)
+
+    # Скорость не опускается ниже десятой части максимальной
+    for _ in range(10):
+        limiter.slow_down()
+
+    assert limiter.rate == pytest.approx(1)
+
+    # После ошибки корзина пуста: следующий запрос ждет
+    assert limiter.reserve() > 0
+
+    # За `recovery_time` скорость полностью восстанавливается
+    clock.now += RateLimiter.recovery_time
+    limiter.reserve()
+    assert limiter.rate == pytest.approx(10)
+
+
+class FakeAPI:
+    """
+    Имитирует `vk.API`: `execute` падает с ошибкой 13, если в нем больше `max_calls`
+    вызовов, а вызовы из `failed` возвращают `False` (как при ошибке внутри `execute`)
+    """
+
+    def __init__(self, max_calls, failed=()):
+        self.max_calls = max_calls
+        self.failed = set(failed)
+        self.executed = []
+        self.single = []
+
+    def execute(self, code):
+        n = code.count('API.')
+        self.executed.append(n)
+
+        if n > self.max_calls:
+            raise VkAPIError({
+                'error_code': 13, 'error_msg': 'Response size is too big', 'request_params': []
+            })
+
+        return [
+            False if offset in self.failed else offset
+            for offset in map(int, re.findall(r'"offset": (\d+)', code))
+        ]
+
+    def __call__(self, method):
+        def call(**params):
+            self.single.append((method, params))
+            return params['offset']
+
+        return call
+
+
+def test_execute_code():
+    assert execute_code('users.get', [{'user_ids': '1'}, {'user_ids': '2'}]) == (
+        'return [API.users.get({"user_ids": "1"}),API.users.get({"user_ids": "2"})];'
+    )
+
+
+def test_execute_splits_on_error_13():
+    api = FakeAPI(max_calls=6)
+    calls = [{'offset': i} for i in range(25)]
+
+    # Ответы возвращаются в порядке вызовов, несмотря на разбиение
+    assert _execute(api, 'messages.getHistory', calls) == list(range(25))
+
+    # 25 -> 12 + 13 -> 6 + 6 + 6 + 7 -> 6 + 6 + 6 + 3 + 4
+    assert api.executed == [25, 12, 6, 6, 13, 6, 7, 3, 4]
+    assert not api.single
+
+
+def test_execute_single_call_error_is_raised():
+    api = FakeAPI(max_calls=0)
+
+    with pytest.raises(VkAPIError):
+        _execute(api, 'messages.getHistory', [{'offset': 0}])
+
+
+def test_execute_retries_failed_calls_separately():
+    api = FakeAPI(max_calls=25, failed={3, 7})
+    calls = [{'offset': i} for i in range(10)]
+
+    assert _execute(api, 'messages.getHistory', calls) == list(range(10))
+    assert api.single == [('messages.getHistory', {'offset': 3}),
+                          ('messages.getHistory', {'offset': 7})]
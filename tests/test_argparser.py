@@ -0,0 +1,35 @@
+import sys
+
+import pytest
+
+from vkms.argparser import parse_args
+
+
+def parse(monkeypatch, *argv):
+    monkeypatch.setattr(sys, 'argv', ['vkms', *argv])
+    return parse_args()
+
+
+@pytest.mark.parametrize('jobs', ('0', '-2'))
+def test_jobs_must_be_positive(monkeypatch, capsys, jobs):
+    with pytest.raises(SystemExit):
+        parse(monkeypatch, 'parse', '-j', jobs)
+
+    assert 'must be a positive number' in capsys.readouterr().err
+
+
+def test_jobs(monkeypatch):
+    assert parse(monkeypatch, 'parse', '-j', '3').jobs == 3
+
+
+@pytest.mark.parametrize('argv', (
+    ('dump', '--token', 't', '--rps', '0'),
+    ('dump', '--token', 't', '--rps', '-1'),
+    ('dump', '--token', 't', '-t', '0'),
+    ('atch', '-t', '-3')
+))
+def test_dump_and_atch_limits_must_be_positive(monkeypatch, capsys, argv):
+    with pytest.raises(SystemExit):
+        parse(monkeypatch, *argv)
+
+    assert 'must be a positive number' in capsys.readouterr().err
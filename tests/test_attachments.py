@@ -0,0 +1,184 @@
+import hashlib
+from contextlib import contextmanager
+
+from requests.exceptions import ConnectionError
+
+from vkms import database as db
+from vkms.attachments import (TIMEOUT, Manifest, _store, download,
+                              gen_attachment, index, select_attachments,
+                              verify)
+
+DATA = b'0123456789'
+
+
+class FakeSession:
+    """
+    Имитирует `requests.Session`: первый ответ обрывается после `broken_at` байт, а
+    следующие поддерживают заголовок `Range`
+    """
+
+    def __init__(self, broken_at):
+        self.broken_at = broken_at
+        self.requests = []
+
+    @contextmanager
+    def get(self, url, stream, headers, timeout):  # noqa: U100
+        self.requests.append((headers.get('Range'), timeout))
+        start = int(headers['Range'][6:-1]) if 'Range' in headers else 0
+
+        class Response:
+            status_code = 206 if start else 200
+            headers = {'Content-Length': str(len(DATA) - start)}
+
+            if start:
+                headers['Content-Range'] = f'bytes {start}-{len(DATA) - 1}/{len(DATA)}'
+
+            @staticmethod
+            def iter_content(chunk_size):  # noqa: U100
+                if self.broken_at is not None:
+                    yield DATA[:self.broken_at]
+                    self.broken_at = None
+                    raise ConnectionError('connection reset')
+
+                yield DATA[start:]
+
+        yield Response()
+
+
+def test_download_resumes_after_broken_connection(tmp_path):
+    atch = gen_attachment({'type': 'doc', 'doc': {
+        'id': 1, 'owner_id': 7, 'title': 'file', 'ext': 'txt', 'url': 'https://example.com/1'
+    }})
+    session = FakeSession(broken_at=4)
+
+    assert atch.download(tmp_path, session)
+    assert atch.get_path(tmp_path).read_bytes() == DATA
+
+    # Полученная до обрыва часть сохранена, и загрузка продолжается с нее
+    assert session.requests == [(None, TIMEOUT), ('bytes=4-', TIMEOUT)]
+
+
+def test_download_resumes_truncated_file(tmp_path):
+    atch = gen_attachment({'type': 'doc', 'doc': {
+        'id': 1, 'owner_id': 7, 'title': 'file', 'ext': 'txt', 'url': 'https://example.com/1',
+        'size': len(DATA)
+    }})
+
+    # Файл, загрузку которого прервала предыдущая версия, не считается загруженным
+    atch.get_path(tmp_path).parent.mkdir(parents=True)
+    atch.get_path(tmp_path).write_bytes(DATA[:4])
+    session = FakeSession(broken_at=None)
+
+    assert atch.download(tmp_path, session)
+    assert atch.get_path(tmp_path).read_bytes() == DATA
+    assert session.requests == [('bytes=4-', TIMEOUT)]
+    assert atch.size == len(DATA)
+
+    # Полностью загруженный файл повторно не загружается
+    assert atch.download(tmp_path, session)
+    assert len(session.requests) == 1
+
+
+def test_download_resumes_interrupted_run(tmp_path):
+    atch = gen_attachment({'type': 'doc', 'doc': {
+        'id': 1, 'owner_id': 7, 'title': 'file', 'ext': 'txt', 'url': 'https://example.com/1'
+    }})
+    manifest = Manifest(tmp_path / 'manifest.sqlite')
+
+    # Предыдущий запуск прервался, успев загрузить часть файла
+    atch.get_part_path(tmp_path).parent.mkdir(parents=True)
+    atch.get_part_path(tmp_path).write_bytes(DATA[:4])
+    session = FakeSession(broken_at=None)
+
+    download(tmp_path, [atch], 2, session, manifest, False)
+
+    assert atch.get_path(tmp_path).read_bytes() == DATA
+    assert not atch.get_part_path(tmp_path).exists()
+    assert session.requests == [('bytes=4-', TIMEOUT)]
+    assert [(entry.path, entry.size) for entry in manifest.entries()] == [
+        ('documents/file_7_1.txt', len(DATA))
+    ]
+
+    # Вложение из манифеста пропускается без запросов
+    download(tmp_path, [atch], 2, session, manifest, False)
+    assert len(session.requests) == 1
+
+
+def photo_msg(msg_id, photo_id, url):
+    return {'id': msg_id, 'attachments': [{'type': 'photo', 'photo': {
+        'id': photo_id, 'owner_id': 7, 'sizes': [{'width': 1, 'height': 1, 'url': url}]
+    }}]}
+
+
+def test_select_attachments_takes_latest_url(tmp_path):
+    session = db.connect(tmp_path / 'peer.sqlite')
+
+    # Одно фото в трех сообщениях: выбирается ссылка из последней записи
+    index(session, [
+        photo_msg(1, 1, 'https://example.com/old'),
+        photo_msg(2, 2, 'https://example.com/other'),
+        photo_msg(3, 1, 'https://example.com/new'),
+        photo_msg(4, 1, 'https://example.com/newest')
+    ])
+
+    atchs = sorted(select_attachments(session, {'photos'}), key=lambda atch: atch.filename)
+    assert [(atch.filename, atch.url) for atch in atchs] == [
+        ('7_1.jpg', 'https://example.com/newest'), ('7_2.jpg', 'https://example.com/other')
+    ]
+    assert not list(select_attachments(session, {'docs'}))
+
+
+def stored_doc(out_dir, doc_id, data):
+    # Загруженный документ, для которого вычислена контрольная сумма
+    atch = gen_attachment({'type': 'doc', 'doc': {
+        'id': doc_id, 'owner_id': 7, 'title': 'file', 'ext': 'txt', 'url': f'https://a/{doc_id}'
+    }})
+    atch.get_path(out_dir).parent.mkdir(parents=True, exist_ok=True)
+    atch.get_path(out_dir).write_bytes(data)
+    atch.describe(out_dir)
+
+    return atch
+
+
+def corrupt_store(out_dir, data, size=None):
+    # Повреждает файл хранилища (по умолчанию не меняя его размер)
+    sha256 = hashlib.sha256(data).hexdigest()
+    stored = out_dir / 'attachments/.store' / sha256[:2] / sha256
+    stored.write_bytes(b'x' * (len(data) if size is None else size))
+
+    return stored
+
+
+def test_store_replaces_corrupted_copy(tmp_path):
+    _store(tmp_path, stored_doc(tmp_path, 1, DATA))
+    stored = corrupt_store(tmp_path, DATA, size=4)
+
+    # Повторно загруженный файл не связывается с поврежденной копией, а заменяет ее
+    atch = stored_doc(tmp_path, 2, DATA)
+    _store(tmp_path, atch)
+
+    assert stored.read_bytes() == DATA
+    assert atch.get_path(tmp_path).read_bytes() == DATA
+    assert stored.samefile(atch.get_path(tmp_path))
+
+
+def test_verify_removes_corrupted_store_files(tmp_path):
+    manifest = Manifest(tmp_path / 'manifest.sqlite')
+
+    for doc_id, data in ((1, DATA), (2, b'other')):
+        atch = stored_doc(tmp_path, doc_id, data)
+        _store(tmp_path, atch)
+        manifest.put(atch)
+
+    manifest.commit()
+    stored = corrupt_store(tmp_path, DATA)
+
+    # Вложение - жесткая ссылка на файл хранилища, поэтому повреждены оба
+    checked, missing, corrupted = verify(tmp_path, manifest, 2)
+
+    assert (checked, missing) == (4, [])
+    assert sorted(corrupted) == sorted([
+        'documents/file_7_1.txt', stored.relative_to(tmp_path / 'attachments').as_posix()
+    ])
+    assert not stored.exists()
+    assert len(list((tmp_path / 'attachments/.store').glob('*/*'))) == 1
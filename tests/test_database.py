@@ -0,0 +1,147 @@
+import datetime
+import json
+import sqlite3
+
+from vkms import database as db
+
+PEER_ID = 2000000001
+
+
+def make_msg(msg_id, **fields):
+    return {
+        'id': msg_id,
+        'date': 1600000000 + msg_id * 60,
+        'from_id': 1 + msg_id % 3,
+        'peer_id': PEER_ID,
+        'text': f'message {msg_id}',
+        'attachments': [],
+        'fwd_messages': [],
+        **fields
+    }
+
+
+def photo(photo_id):
+    return {'type': 'photo', 'photo': {
+        'id': photo_id,
+        'owner_id': 7,
+        'sizes': [{'width': 10, 'height': 10, 'url': f'https://example.com/{photo_id}.jpg'}]
+    }}
+
+
+def create_legacy_db(path, msgs):
+    # Создает БД переписки в формате первых версий VKMS (до миграций)
+    conn = sqlite3.connect(path)
+    conn.executescript(
+        'CREATE TABLE peer (id INTEGER PRIMARY KEY, account JSON NOT NULL, info JSON NOT NULL);'
+        'CREATE TABLE messages (id INTEGER PRIMARY KEY, json JSON NOT NULL, '
+        'date DATETIME NOT NULL);'
+        'CREATE TABLE users (id INTEGER PRIMARY KEY, json JSON NOT NULL);'
+    )
+    conn.execute('INSERT INTO peer VALUES (?, ?, ?)', (
+        PEER_ID, json.dumps({'id': 1}), json.dumps({'peer': {'id': PEER_ID, 'type': 'chat'}})
+    ))
+    conn.executemany('INSERT INTO messages VALUES (?, ?, ?)', [
+        (msg['id'], json.dumps(msg), str(datetime.datetime.fromtimestamp(msg['date'])))
+        for msg in msgs
+    ])
+    conn.commit()
+    conn.close()
+
+
+def test_migrations(tmp_path):
+    path = tmp_path / f'{PEER_ID}.sqlite'
+    msgs = [make_msg(i) for i in range(1, 101)]
+    msgs[9]['attachments'].append(photo(1))
+    msgs[19]['fwd_messages'].append(make_msg(1000, attachments=[photo(2)], text='forwarded'))
+    msgs[29]['reply_message'] = make_msg(5, text='reply')
+    create_legacy_db(path, msgs)
+
+    session = db.connect(path)
+    conn = session.connection()
+
+    assert conn.exec_driver_sql('PRAGMA user_version').scalar() == len(db._migrations)
+
+    # Поля, извлеченные из JSON
+    msg = session.get(db.Message, 20)
+    assert (msg.from_id, msg.fwd_count, msg.has_reply) == (3, 1, False)
+    assert msg.atch_flags == db.ATCH_FLAGS['photo']
+    assert session.get(db.Message, 30).has_reply
+
+    # Метаданные синхронизации
+    sync = session.get(db.SyncInfo, PEER_ID)
+    assert (sync.last_msg_id, sync.msg_count) == (100, 100)
+
+    # Полнотекстовый индекс (включая пересланные сообщения)
+    assert [row[0] for row in db.search(session, 'forwarded', 10)] == [20]
+
+    # Таблица вложений
+    assert sorted(session.query(db.Attachment.msg_id, db.Attachment.filename)) == [
+        (10, '7_1.jpg'), (20, '7_2.jpg')
+    ]
+
+    session.close()
+    session.get_bind().dispose()
+
+    # Повторное подключение не применяет миграции заново
+    session = db.connect(path)
+    assert session.query(db.Attachment).count() == 2
+    assert len(db.search(session, 'message', 1000)) == 100
+
+
+def test_new_db_has_latest_schema(tmp_path):
+    session = db.connect(tmp_path / 'new.sqlite')
+
+    version = session.connection().exec_driver_sql('PRAGMA user_version').scalar()
+    assert version == len(db._migrations)
+
+
+def test_compressed_json_roundtrip(tmp_path):
+    path = tmp_path / 'peer.sqlite'
+    msg = make_msg(1, text='сжатый текст')
+
+    session = db.connect(path, compress=True)
+    db.insert(session, db.Message, [msg])
+    session.commit()
+
+    assert isinstance(
+        session.connection().exec_driver_sql('SELECT json FROM messages').scalar(), bytes
+    )
+    assert session.get(db.Message, 1).json == msg
+
+    session.close()
+    session.get_bind().dispose()
+
+    # Распаковка возвращает обычный JSON
+    db.convert(path, False)
+
+    session = db.connect(path)
+    assert isinstance(
+        session.connection().exec_driver_sql('SELECT json FROM messages').scalar(), str
+    )
+    assert session.get(db.Message, 1).json == msg
+
+
+def test_convert_checkpoints_wal(tmp_path):
+    path = tmp_path / 'peer.sqlite'
+    wal = tmp_path / 'peer.sqlite-wal'
+
+    session = db.connect(path, ingest=True)
+    db.insert(session, db.Message, [make_msg(i, text='текст ' * 100) for i in range(1, 501)])
+    session.commit()
+
+    # Пока БД открыта, данные еще в журнале WAL
+    assert wal.stat().st_size > 0
+    assert db.size(path) == path.stat().st_size + wal.stat().st_size + (
+        tmp_path / 'peer.sqlite-shm'
+    ).stat().st_size
+
+    session.close()
+    session.get_bind().dispose()
+
+    db.convert(path, True)
+
+    # После преобразования журнал перенесен в основной файл
+    assert not wal.exists() or wal.stat().st_size == 0
+
+    session = db.connect(path)
+    assert session.query(db.Message).count() == 500
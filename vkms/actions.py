@@ -1,18 +1,27 @@
+import asyncio
 import logging
-from time import sleep
+from concurrent.futures import (FIRST_COMPLETED, ProcessPoolExecutor,
+                                ThreadPoolExecutor, as_completed, wait)
+from logging.handlers import QueueHandler, QueueListener
+from multiprocessing import Manager
+from operator import itemgetter
 
-import vk
-from sqlalchemy import func
+from requests.exceptions import RequestException
 from vk.exceptions import VkAPIError
 
 from . import attachments
 from . import database as db
-from . import messages, peers, saver, users
+from . import messages, net, peers, saver, users
+from .api import API, RateLimiter
+from .utils import chunks
 
 log = logging.getLogger(__name__)
 
 
-def dump(out_dir, include, exclude, token, nthreads, max_msgs, append, export_json):
+def dump(
+    out_dir, include, exclude, token, engine, nthreads, rps, execute, profiles_ttl, max_msgs,
+    append, compress, export_json
+):
     """
     Скачивает указанные переписки в формате JSON (результаты обращений к VK API)
 
@@ -22,35 +31,234 @@ def dump(out_dir, include, exclude, token, nthreads, max_msgs, append, export_js
         include (set): Множество идентификаторов переписок, которые нужно сохранить
         exclude (set): Множество идентификаторов переписок, которые не нужно сохранять
         token (str): Токен доступа к VK API
-        nthreads (int): Количество потоков, загружающих переписки
+        engine (str): Движок загрузки: `threads` (пулы потоков) или `asyncio`
+        nthreads (int): Количество потоков, загружающих переписки (для движка `asyncio` -
+            кол-во одновременных запросов). Ограничение действует на все переписки сразу,
+            а не на каждую по отдельности
+        rps (float): Максимальное количество запросов к VK API в секунду
+        execute (bool): Упаковывать запросы к VK API в `execute` (до 25 запросов в одном)
+        profiles_ttl (float): Время (в днях), в течение которого информация о пользователях
+            и группах в общем кэше считается актуальной
         max_msgs (int):  Кол-во сообщений, которое нужно сохранить (может быть меньше
             заявленного, если переписка содержит меньше сообщений)
         append (bool): Режим дозаписи новых сообщений
+        compress (bool): Сжимать JSON сохраняемых сообщений и пользователей
         export_json (bool): Дополнительно экспортировать данные о переписке а JSON формате
     """
-    # Получаем объект для работы с VK API
-    class API(vk.API):
-        def on_api_error_6(self, request):
-            sleep(1)
-            return self.send(request)
-
-        def get_captcha_key(self, request):
-            return input(f'Captcha needed ({request.api_error.captcha_img}): ')
+    if engine == 'asyncio':
+        asyncio.run(_dump_async(
+            out_dir, include, exclude, token, nthreads, rps, execute, profiles_ttl, max_msgs,
+            append, compress, export_json
+        ))
+        return
 
-    api = API(access_token=token, v='5.131')
+    # Получаем объект для работы с VK API, все потоки используют общий ограничитель частоты
+    api = API(
+        access_token=token,
+        rate_limiter=RateLimiter(rps),
+        session=net.create_session(nthreads),
+        v='5.131'
+    )
 
     # Загружаем информацию о владельце страницы
     try:
         account = api.users.get()[0]
     except VkAPIError:
         print('Failed to load base information. '
-              'See logs for details: ' + out_dir / 'logs.txt')
+              f"See logs for details: {out_dir / 'logs.txt'}")
 
         return
 
-    # Загружаем информацию о всех переписках пользователя
-    peers_info = peers.download(api)
+    # Загружаем информацию о всех переписках пользователя и их участниках
+    peers_info, profiles = peers.download(api)
+
+    peer_by_id, peer_ids, state, cache = _select_peers(
+        out_dir, include, exclude, profiles_ttl, append, peers_info, profiles
+    )
+
+    # Запросы к VK API всех переписок выполняются в одном общем пуле потоков, поэтому
+    # одновременно выполняется не более `nthreads` запросов, сколько бы переписок ни
+    # загружалось параллельно. Сами переписки обрабатываются в отдельном пуле
+    with ThreadPoolExecutor(nthreads, 'Thread-') as executor, \
+            ThreadPoolExecutor(nthreads, 'Peer-') as peers_executor:
+
+        def submit(peer_id):
+            return peers_executor.submit(
+                _dump_peer,
+                out_dir,
+                api,
+                executor,
+                nthreads,
+                execute,
+                cache,
+                account,
+                peer_by_id[peer_id],
+                max_msgs,
+                append,
+                compress,
+                export_json
+            )
+
+        tasks = {submit(peer_id): peer_id for peer_id in peer_ids}
+        results = _PeerResults(state, peer_ids)
+
+        while tasks:
+            done, _ = wait(tasks, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                peer_id = tasks.pop(future)
+
+                # Неудавшаяся переписка ставится в конец очереди и при повторной
+                # попытке продолжает загрузку с последней контрольной точки
+                if results.add(peer_id, future):
+                    tasks[submit(peer_id)] = peer_id
+
+    _report(out_dir, results.failed)
+
+
+async def _dump_async(
+    out_dir, include, exclude, token, concurrency, rps, execute, profiles_ttl, max_msgs, append,
+    compress, export_json
+):
+    """
+    Асинхронный вариант `dump`. Переписки загружаются корутинами в одном потоке, а
+    одновременно выполняется не более `concurrency` запросов к VK API. Результат
+    (БД переписок и состояние синхронизации) такой же, как у движка `threads`
+
+    Запись в SQLite выполняется синхронно в цикле событий: пока сохраняется страница
+    сообщений, запросы не обрабатываются. Страница сохраняется за миллисекунды, поэтому
+    это не ограничивает скорость загрузки, но большие значения `concurrency` не
+    ускоряют запись в БД
+    """
+    from . import aio
+
+    async with aio.AsyncAPI(
+        access_token=token,
+        rate_limiter=RateLimiter(rps),
+        concurrency=concurrency,
+        v='5.131'
+    ) as api:
+        try:
+            account = (await api.users.get())[0]
+        except VkAPIError:
+            print('Failed to load base information. '
+                  f"See logs for details: {out_dir / 'logs.txt'}")
+
+            return
+
+        peers_info, profiles = await peers.download_async(api)
+
+        peer_by_id, peer_ids, state, cache = _select_peers(
+            out_dir, include, exclude, profiles_ttl, append, peers_info, profiles
+        )
+
+        # Одновременно обрабатывается не больше переписок, чем в движке `threads`
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def dump_peer(peer_id):
+            async with semaphore:
+                return await _dump_peer_async(
+                    out_dir,
+                    api,
+                    concurrency,
+                    execute,
+                    cache,
+                    account,
+                    peer_by_id[peer_id],
+                    max_msgs,
+                    append,
+                    compress,
+                    export_json
+                )
+
+        def submit(peer_id):
+            return asyncio.ensure_future(dump_peer(peer_id))
+
+        tasks = {submit(peer_id): peer_id for peer_id in peer_ids}
+        results = _PeerResults(state, peer_ids)
+
+        while tasks:
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+
+            for task in done:
+                peer_id = tasks.pop(task)
+
+                if results.add(peer_id, task):
+                    tasks[submit(peer_id)] = peer_id
+
+    _report(out_dir, results.failed)
+
+
+class _PeerResults:
+    """
+    Учитывает результаты загрузки переписок одинаково для обоих движков: сохраняет
+    состояние синхронизации, выводит прогресс и решает, нужно ли повторить загрузку
+
+    Args:
+        state (sqlalchemy.orm.Session): Сессия БД состояния синхронизации
+        peer_ids (Iterable[int]): Идентификаторы загружаемых переписок
+    """
+
+    # Максимальное кол-во попыток загрузки одной переписки
+    max_attempts = 3
+
+    def __init__(self, state, peer_ids):
+        self.state = state
+        self.attempts = dict.fromkeys(peer_ids, 1)
+        self.failed = []
+        self.processed = 0
+
+        print('0%', end='\r')
+
+    def add(self, peer_id, task):
+        """
+        Учитывает завершившуюся загрузку переписки
+
+        Args:
+            peer_id (int): Идентификатор переписки
+            task (Union[concurrent.futures.Future, asyncio.Task]): Завершившаяся задача
+                `_dump_peer` или `_dump_peer_async`
+
+        Returns:
+            bool: Нужно ли повторить загрузку
+        """
+        try:
+            last_msg_id = task.result()
+        except Exception:
+            # Непредвиденная ошибка (например, неожиданный ответ VK API) не останавливает
+            # загрузку остальных переписок. Повторять такую загрузку бессмысленно, поэтому
+            # переписка сразу считается неудавшейся
+            log.exception(f'Downloading peer {peer_id} failed')
+            self.failed.append(peer_id)
+            return False
+
+        if last_msg_id is not None:
+            # Запоминаем последнее сообщение, чтобы при дозаписи пропустить переписку,
+            # если в ней ничего не изменится
+            self.state.merge(db.PeerState(id=peer_id, last_msg_id=last_msg_id))
+            self.state.commit()
+
+            self.processed += 1
+            print(f'{round(self.processed / len(self.attempts) * 100)}%', end='\r')
+            return False
+
+        if self.attempts[peer_id] < self.max_attempts:
+            self.attempts[peer_id] += 1
+            return True
+
+        self.failed.append(peer_id)
+        return False
+
+
+def _select_peers(out_dir, include, exclude, profiles_ttl, append, peers_info, profiles):
+    """
+    Выбирает переписки, которые нужно загрузить, и подготавливает общие для всех
+    переписок состояние синхронизации и кэш пользователей
 
+    Returns:
+        Tuple[dict, list, Session, users.Cache]: Словарь вида id-переписка, идентификаторы
+            выбранных переписок, сессия БД состояния синхронизации и кэш пользователей
+    """
     # Создаем словарь вида id-переписка для быстрого доступа к JSON'у конкретной переписки
     peer_by_id = {peer['peer']['id']: peer for peer in peers_info}
 
@@ -63,93 +271,350 @@ def dump(out_dir, include, exclude, token, nthreads, max_msgs, append, export_js
     elif exclude:
         peer_ids -= exclude
 
+    # Состояние синхронизации переписок после предыдущих запусков
+    state = db.connect(out_dir / '.state/peers.sqlite', db.StateBase)
+
+    # Кэш пользователей и групп, общий для всех переписок
+    cache = users.Cache(out_dir / '.state/profiles.sqlite', profiles_ttl)
+
+    # Участники, полученные вместе с переписками, не будут загружаться отдельно
+    cache.put(profiles)
+
+    if append:
+        last_msg_ids = dict(state.query(db.PeerState.id, db.PeerState.last_msg_id))
+
+        # Пропускаем переписки, в которых не появилось новых сообщений. Для них не
+        # нужно ни обращаться к VK API, ни открывать БД
+        unchanged = {
+            peer_id for peer_id in peer_ids
+            if peer_by_id[peer_id].get('last_message_id') == last_msg_ids.get(peer_id)
+            and (out_dir / f'.sqlite/{peer_id}.sqlite').exists()
+        }
+        peer_ids -= unchanged
+
+        log.info(f'Skipped {len(unchanged)} unchanged peers')
+
     peer_ids = list(peer_ids)
 
-    processed = 0
+    # Пока загрузка не завершена, состояние выбранных переписок недействительно
+    for chunk in chunks(peer_ids, 500):
+        state.query(db.PeerState).filter(db.PeerState.id.in_(chunk)).delete()
+
+    state.commit()
 
     log.debug(f"Peers: {', '.join(map(str, peer_ids))}")
 
-    # Обрабатываем каждую переписку отдельно
-    for peer_id in peer_ids:
-        log.debug(f'Processing peer {peer_id}')
+    return peer_by_id, peer_ids, state, cache
 
-        print(f'{round(processed / len(peer_ids) * 100)}%', end='\r')
 
-        db_path = out_dir / f'.sqlite/{peer_id}.sqlite'
+def _report(out_dir, failed):
+    # Выводит итог загрузки переписок
+    print('100%')
 
-        if not append:
-            # Если переписку нужно загрузить заново, полностью очищаем БД
-            db_path.unlink(missing_ok=True)
+    if failed:
+        print(f"Failed to download peers: {', '.join(map(str, failed))}. "
+              f"Run the command again to resume. See logs for details: {out_dir / 'logs.txt'}")
 
-        session = db.connect(db_path)
 
-        if not append:
-            # Сохраняем информацию о переписке и владельце страницы
-            db.Base.metadata.create_all(session.bind)
-            session.add(db.Peer(id=peer_id, account=account, info=peer_by_id[peer_id]))
-            session.flush()
+def _dump_peer(
+    out_dir, api, executor, window, execute, cache, account, peer_info, max_msgs, append,
+    compress, export_json
+):
+    """
+    Скачивает одну переписку. Вызывается параллельно для разных переписок, поэтому
+    каждый вызов работает со своей сессией БД
 
-        try:
-            # Сохраняем все сообщения и информацию об участниках переписки
-            user_ids = set()
-            group_ids = set()
-
-            pres_user_ids = {
-                id for id, in
-                session.query(db.User.id).filter(db.User.id > 0)
-            }
-            pres_group_ids = {
-                abs(id) for id, in
-                session.query(db.User.id).filter(db.User.id < 0)
-            }
-
-            # Идентификатор последнего сообщения переписки
-            start_msg_id, _ = session.query(
-                db.Message.id,
-                func.max(db.Message.date)
-            ).one_or_none()
-
-            # Случай, если мы отправили сообщение, но попали в игнор
-            if peer_by_id[peer_id]['peer']['type'] != 'chat':
-                users.collect({'from_id': peer_id}, user_ids, group_ids)
-
-            for chunk in messages.download(api, peer_id, nthreads, max_msgs, start_msg_id):
-                msgs = []
-
-                for msg_json in chunk:
-                    msg = db.Message(json=msg_json)
-                    msgs.append(msg)
-
-                    users.collect(msg_json, user_ids, group_ids)
-
-                session.bulk_save_objects(msgs)
-
-            if user_ids or group_ids:
-                # Исключаем пользователей, которые уже есть в БД
-                user_ids -= pres_user_ids
-                group_ids -= pres_group_ids
-
-                for chunk in users.download(api, nthreads, user_ids, group_ids):
-                    session.bulk_save_objects(db.User(user_json) for user_json in chunk)
-
-        except VkAPIError as e:
-            log.error(f'Downloading peer {peer_id} failed: {e}')
-            session.rollback()
-            return
+    Каждый загруженный чанк сообщений сохраняется вместе с контрольной точкой
+    (`db.Progress`), поэтому прерванная загрузка продолжается с того же места
 
-        # Все хорошо, сохраняем изменения
-        session.commit()
+    Args:
+        out_dir (str): Абсолютный путь к каталогу, в котором находится
+            результат работы программы
+        api (vk.API): Объект, через который происходит обращение к методам VK API
+        executor (ThreadPoolExecutor): Общий для всех переписок пул запросов к VK API
+        window (int): Максимальное кол-во одновременно загружаемых запросов переписки
+        execute (bool): Упаковывать запросы к VK API в `execute`
+        cache (users.Cache): Общий для всех переписок кэш пользователей и групп
+        account (dict): Информация о владельце страницы
+        peer_info (dict): Информация о переписке
+        max_msgs (int): Кол-во сообщений, которое нужно сохранить
+        append (bool): Режим дозаписи новых сообщений
+        compress (bool): Сжимать JSON сохраняемых сообщений и пользователей
+        export_json (bool): Дополнительно экспортировать данные о переписке а JSON формате
 
-        # Если нужно, дополнительно экспортируем информацию в JSON
-        if export_json:
-            peers.export_json(out_dir, session)
+    Returns:
+        Union[int, None]: Идентификатор последнего сохраненного сообщения (0, если
+            переписка пустая) или `None`, если загрузку не удалось завершить
+    """
+    peer_id = peer_info['peer']['id']
+    session, progress, sync = _open_peer(out_dir, account, peer_info, append, compress)
 
-        processed += 1
+    try:
+        if append or progress is None:
+            count = messages.count(api, executor, peer_id)
+            progress = _start_progress(session, sync, count, max_msgs)
+
+        # Сохраняем все сообщения и информацию об участниках переписки
+        user_ids, group_ids = _member_ids(peer_info)
+        resumed = progress.done
+
+        for done, page in messages.download(
+            api,
+            executor,
+            peer_id,
+            progress.start_msg_id,
+            progress.offset + resumed,
+            progress.count - resumed,
+            execute,
+            window
+        ):
+            _save_page(session, sync, page, user_ids, group_ids)
+
+            # Каждые 5000 сообщений сохраняем вместе с контрольной точкой
+            if resumed + done - progress.done >= 5000:
+                _save_users(api, executor, execute, cache, session, user_ids, group_ids)
+
+                progress.done = resumed + done
+                session.commit()
+
+        _save_users(api, executor, execute, cache, session, user_ids, group_ids)
+
+        return _finish_peer(out_dir, session, progress, sync, export_json)
+
+    except (VkAPIError, RequestException) as e:
+        log.error(f'Downloading peer {peer_id} failed: {e}')
+        session.rollback()
+        return None
+
+    finally:
+        _close_peer(session)
+
+
+async def _dump_peer_async(
+    out_dir, api, window, execute, cache, account, peer_info, max_msgs, append, compress,
+    export_json
+):
+    """
+    Асинхронный вариант `_dump_peer`
 
-    print('100%')
+    Returns:
+        Union[int, None]: Идентификатор последнего сохраненного сообщения (0, если
+            переписка пустая) или `None`, если загрузку не удалось завершить
+    """
+    from .aio import NETWORK_ERRORS
+
+    peer_id = peer_info['peer']['id']
+    session, progress, sync = _open_peer(out_dir, account, peer_info, append, compress)
+
+    try:
+        if append or progress is None:
+            count = await messages.count_async(api, peer_id)
+            progress = _start_progress(session, sync, count, max_msgs)
+
+        user_ids, group_ids = _member_ids(peer_info)
+        resumed = progress.done
+
+        async for done, page in messages.download_async(
+            api,
+            peer_id,
+            progress.start_msg_id,
+            progress.offset + resumed,
+            progress.count - resumed,
+            execute,
+            window
+        ):
+            _save_page(session, sync, page, user_ids, group_ids)
+
+            if resumed + done - progress.done >= 5000:
+                await _save_users_async(api, execute, cache, session, user_ids, group_ids)
+
+                progress.done = resumed + done
+                session.commit()
+
+        await _save_users_async(api, execute, cache, session, user_ids, group_ids)
+
+        return _finish_peer(out_dir, session, progress, sync, export_json)
+
+    except (VkAPIError, *NETWORK_ERRORS) as e:
+        log.error(f'Downloading peer {peer_id} failed: {e}')
+        session.rollback()
+        return None
+
+    finally:
+        _close_peer(session)
+
+
+def _open_peer(out_dir, account, peer_info, append, compress):
+    """
+    Открывает БД переписки. Если переписку нужно загрузить заново, БД очищается
+
+    Returns:
+        Tuple[Session, Union[db.Progress, None], db.SyncInfo]: Сессия БД переписки,
+            незавершенная загрузка, которую нужно продолжить, и метаданные синхронизации
+    """
+    peer_id = peer_info['peer']['id']
+
+    log.debug(f'Processing peer {peer_id}')
+
+    db_path = out_dir / f'.sqlite/{peer_id}.sqlite'
+
+    # Если переписку нужно загрузить заново, полностью очищаем БД. Это проверяется до
+    # подключения, чтобы не применять миграции к БД, которая все равно будет удалена
+    if not append and not db.has_progress(db_path):
+        # Вместе с БД удаляем и журнал WAL, иначе он будет применен к новой БД
+        for suffix in ('', '-wal', '-shm'):
+            db_path.with_name(db_path.name + suffix).unlink(missing_ok=True)
+
+    session = db.connect(db_path, ingest=True, compress=compress)
+
+    # Незавершенная загрузка, которую нужно продолжить
+    progress = session.get(db.Progress, peer_id)
+
+    if not append and progress is not None:
+        log.info(f'Resuming peer {peer_id} from {progress.done}/{progress.count}')
+
+    if session.get(db.Peer, peer_id) is None:
+        # Сохраняем информацию о переписке и владельце страницы
+        session.add(db.Peer(id=peer_id, account=account, info=peer_info))
+
+    sync = session.get(db.SyncInfo, peer_id)
+
+    if sync is None:
+        sync = db.SyncInfo(id=peer_id, msg_count=0)
+        session.add(sync)
+
+    return session, progress, sync
+
+
+def _close_peer(session):
+    # Закрывает БД переписки. Без этого при обработке большого кол-ва переписок файлы
+    # БД и журналов WAL остаются открытыми до завершения программы
+    session.close()
+    session.get_bind().dispose()
+
+
+def _start_progress(session, sync, count, max_msgs):
+    """
+    Создает контрольную точку новой загрузки переписки
+
+    Returns:
+        db.Progress: Контрольная точка
+    """
+    # Идентификатор последнего сообщения переписки
+    start_msg_id = sync.last_msg_id
+
+    # Новых сообщений не больше, чем сообщений в переписке. При дозаписи их точное кол-во
+    # неизвестно (часть сохраненных могла быть удалена), поэтому загрузка идет до первой
+    # неполной страницы (см. `messages.download`)
+    max_msgs = min(max_msgs, count)
+
+    # При дозаписи смещение отсчитывается от последнего сообщения,
+    # иначе - от самого старого сообщения переписки
+    progress = session.merge(db.Progress(
+        id=sync.id,
+        start_msg_id=start_msg_id,
+        offset=0 if start_msg_id else count - max_msgs,
+        count=max_msgs,
+        done=0
+    ))
+    session.commit()
+
+    return progress
+
+
+def _member_ids(peer_info):
+    # Возвращает множества идентификаторов участников переписки (пользователей и групп)
+    user_ids = set()
+    group_ids = set()
+
+    # Случай, если мы отправили сообщение, но попали в игнор
+    if peer_info['peer']['type'] != 'chat':
+        users.collect({'from_id': peer_info['peer']['id']}, user_ids, group_ids)
+
+    return user_ids, group_ids
+
+
+def _save_page(session, sync, page, user_ids, group_ids):
+    # Сохраняет страницу сообщений и собирает идентификаторы их авторов
+    db.insert(session, db.Message, page)
+    db.index_text(session, page)
+    attachments.index(session, page)
+    sync.update(page)
+
+    for msg_json in page:
+        users.collect(msg_json, user_ids, group_ids)
+
+
+def _finish_peer(out_dir, session, progress, sync, export_json):
+    """
+    Завершает загрузку переписки
+
+    Returns:
+        int: Идентификатор последнего сохраненного сообщения (0, если переписка пустая)
+    """
+    if progress.start_msg_id:
+        appended = session.query(db.Message).filter(db.Message.id > progress.start_msg_id).count()
+
+        log.info(f'Appended {appended} new messages to peer {sync.id}')
+
+    # Все хорошо, загрузка завершена
+    session.delete(progress)
+    session.commit()
+
+    # Если нужно, дополнительно экспортируем информацию в JSON
+    if export_json:
+        peers.export_json(out_dir, session)
+
+    return sync.last_msg_id or 0
+
+
+def _save_users(api, executor, execute, cache, session, user_ids, group_ids):
+    """
+    Сохраняет участников переписки, которых еще нет в БД. Участники берутся из кэша,
+    а загружаются только отсутствующие в нем. Множества идентификаторов после этого
+    очищаются
+    """
+    _save_cached_users(cache, session, user_ids, group_ids)
 
+    if user_ids or group_ids:
+        for chunk in users.download(api, executor, user_ids, group_ids, execute):
+            db.insert(session, db.User, chunk)
+            cache.put(chunk)
 
-def parse(out_dir, include, exclude, fmt):
+    user_ids.clear()
+    group_ids.clear()
+
+
+async def _save_users_async(api, execute, cache, session, user_ids, group_ids):
+    # Асинхронный вариант `_save_users`
+    _save_cached_users(cache, session, user_ids, group_ids)
+
+    if user_ids or group_ids:
+        async for chunk in users.download_async(api, user_ids, group_ids, execute):
+            db.insert(session, db.User, chunk)
+            cache.put(chunk)
+
+    user_ids.clear()
+    group_ids.clear()
+
+
+def _save_cached_users(cache, session, user_ids, group_ids):
+    # Исключаем пользователей, которые уже есть в БД
+    user_ids -= {id for id, in session.query(db.User.id).filter(db.User.id > 0)}
+    group_ids -= {abs(id) for id, in session.query(db.User.id).filter(db.User.id < 0)}
+
+    # Сохраняем пользователей, которые есть в кэше
+    for user_json in cache.get(user_ids | {-id for id in group_ids}):
+        user = db.User(user_json)
+        session.add(user)
+
+        if user.id > 0:
+            user_ids.discard(user.id)
+        else:
+            group_ids.discard(-user.id)
+
+
+def parse(out_dir, include, exclude, fmt, jobs, paginate):
     """
     Сохраняет полученные переписки в удобном для чтения формате
 
@@ -159,6 +624,9 @@ def parse(out_dir, include, exclude, fmt):
         include (set): Множество идентификаторов переписок, которые нужно сохранить
         exclude (set): Множество идентификаторов переписок, которые не нужно сохранять
         fmt (str): Формат, в котором следует сохранять переписки
+        jobs (int): Количество процессов, одновременно обрабатывающих переписки
+        paginate (Union[str, int, None]): Разбиение переписок на страницы (см.
+            `saver.save_html`)
     """
     # Получаем идентификаторы всех скачанных переписок
     peer_ids = {int(file.name.rstrip('.sqlite')) for file in out_dir.glob('.sqlite/*.sqlite')}
@@ -173,23 +641,235 @@ def parse(out_dir, include, exclude, fmt):
 
     log.debug(f"Peers: {', '.join(map(str, peer_ids))}")
 
-    # Обрабатываем каждую переписку отдельно
+    # Манифест сохраненных переписок, общий для всех форматов
+    renders = db.connect(out_dir / '.state/renders.sqlite', db.RenderBase)
+    signature = saver.signature(fmt, paginate)
+
+    # Пропускаем переписки, которые не изменились с прошлого сохранения
+    states = {}
+
     for peer_id in peer_ids:
-        log.debug(f'Processing peer {peer_id}')
+        state = _peer_state(out_dir, peer_id)
+        render = renders.get(db.Render, (fmt, peer_id))
+
+        if not (
+            render is not None
+            and render.signature == signature
+            and (render.last_msg_id, render.msg_count, render.synced) == state
+            and (out_dir / render.path).exists()
+        ):
+            states[peer_id] = state
+
+    if len(states) < len(peer_ids):
+        log.info(f'Skipping {len(peer_ids) - len(states)} unchanged peers')
+
+    peer_ids = set(states)
+
+    # Общие стили и скрипты сохраняем один раз для всех переписок
+    if fmt == 'html':
+        saver.save_assets(out_dir)
+
+    def save_render(peer_id, path):
+        # Запоминаем, по какому состоянию БД была сохранена переписка
+        last_msg_id, msg_count, synced = states[peer_id]
+
+        renders.merge(db.Render(
+            fmt=fmt,
+            peer_id=peer_id,
+            last_msg_id=last_msg_id,
+            msg_count=msg_count,
+            synced=synced,
+            signature=signature,
+            path=path.relative_to(out_dir).as_posix()
+        ))
+        renders.commit()
+
+    if jobs == 1:
+        # Обрабатываем каждую переписку отдельно
+        for peer_id in peer_ids:
+            print(f'{round(processed / len(peer_ids) * 100)}%', end='\r')
+
+            save_render(peer_id, _parse_peer(out_dir, fmt, peer_id, paginate))
+            processed += 1
+
+        print('100%')
+        return
+
+    # Обработка переписки - работа процессора, поэтому переписки обрабатываются в
+    # отдельных процессах. Большие переписки запускаем первыми, чтобы в конце не
+    # ждать одну долгую
+    peer_ids = sorted(
+        peer_ids, key=lambda peer_id: (out_dir / f'.sqlite/{peer_id}.sqlite').stat().st_size,
+        reverse=True
+    )
+
+    levels = {
+        name: logging.getLogger(name).level
+        for name in (None, 'vk', 'sqlalchemy', 'urllib3')
+    }
+
+    # Логи процессов передаются в основной процесс и пишутся его обработчиками
+    with Manager() as manager:
+        log_queue = manager.Queue()
+        listener = QueueListener(log_queue, *logging.getLogger().handlers)
+        listener.start()
+
+        try:
+            with ProcessPoolExecutor(
+                jobs, initializer=_init_worker, initargs=(log_queue, levels)
+            ) as executor:
+                futures = {
+                    executor.submit(_parse_peer, out_dir, fmt, peer_id, paginate): peer_id
+                    for peer_id in peer_ids
+                }
+
+                for future in as_completed(futures):
+                    save_render(futures[future], future.result())
+                    processed += 1
+
+                    print(f'{round(processed / len(peer_ids) * 100)}%', end='\r')
+
+        finally:
+            listener.stop()
+
+    print('100%')
+
+
+def _parse_peer(out_dir, fmt, peer_id, paginate):
+    # Сохраняет одну переписку в удобном для чтения формате (выполняется и в дочерних
+    # процессах, см. `parse`) и возвращает путь к сохраненному файлу
+    log.debug(f'Processing peer {peer_id}')
+
+    session = db.connect(out_dir / f'.sqlite/{peer_id}.sqlite')
+
+    try:
+        peer = peers.Peer(session)
+        return saver.save(out_dir, fmt, peer, paginate)
 
+    finally:
+        _close_peer(session)
+
+
+def _peer_state(out_dir, peer_id):
+    # Состояние БД переписки: последнее сообщение, кол-во сообщений и время последнего
+    # сохранения. Если оно не изменилось, переписку не нужно сохранять заново
+    session = db.connect(out_dir / f'.sqlite/{peer_id}.sqlite')
+    sync = session.get(db.SyncInfo, peer_id)
+
+    _close_peer(session)
+
+    if sync is None:
+        return None, None, None
+
+    return sync.last_msg_id, sync.msg_count, sync.synced
+
+
+def _init_worker(log_queue, levels):
+    # Настраивает логирование дочернего процесса: записи отправляются в основной процесс
+    root = logging.getLogger()
+    root.handlers = [QueueHandler(log_queue)]
+
+    for name, level in levels.items():
+        logging.getLogger(name).setLevel(level)
+
+
+def search(out_dir, include, exclude, query, limit):
+    """
+    Ищет сообщения в сохраненных переписках и выводит наиболее подходящие
+
+    Args:
+        out_dir (str): Абсолютный путь к каталогу, в котором находится
+            результат работы программы
+        include (set): Множество идентификаторов переписок, в которых нужно искать
+        exclude (set): Множество идентификаторов переписок, в которых не нужно искать
+        query (str): Поисковый запрос
+        limit (int): Максимальное кол-во выводимых сообщений
+    """
+    # Получаем идентификаторы всех скачанных переписок
+    peer_ids = {int(file.name.rstrip('.sqlite')) for file in out_dir.glob('.sqlite/*.sqlite')}
+
+    # Выбираем нужные переписки
+    if include:
+        peer_ids &= include
+    elif exclude:
+        peer_ids -= exclude
+
+    log.debug(f"Peers: {', '.join(map(str, peer_ids))}")
+
+    results = []
+
+    # Из каждой переписки берем лучшие результаты. Релевантность bm25 вычисляется по
+    # статистике индекса отдельной переписки, поэтому значения из разных переписок не
+    # сравнимы: результаты чередуются по месту внутри своей переписки, а релевантность
+    # упорядочивает только результаты с одинаковым местом
+    for peer_id in peer_ids:
         session = db.connect(out_dir / f'.sqlite/{peer_id}.sqlite')
+        found = db.search(session, query, limit)
+
+        if found:
+            usernames = users.parse(session)
+            title = peers.get_title(session.query(db.Peer.info).scalar(), usernames)
+
+            results.extend(
+                (place, rank, title, peer_id, date, usernames.get(from_id, from_id), snippet)
+                for place, (_, date, from_id, snippet, rank) in enumerate(found)
+            )
+
+        _close_peer(session)
+
+    results.sort(key=itemgetter(0, 1))
+
+    for _, _, title, peer_id, date, username, snippet in results[:limit]:
+        snippet = ' '.join(snippet.split())
+        print(f"{title} ({peer_id}) [{date.strftime('%d.%m.%Y %H:%M')}] {username}: {snippet}")
+
+    if not results:
+        print('Nothing found')
+
+
+def convert(out_dir, include, exclude, compress):
+    """
+    Перезаписывает сохраненные переписки в сжатом или несжатом формате
+
+    Args:
+        out_dir (str): Абсолютный путь к каталогу, в котором находится
+            результат работы программы
+        include (set): Множество идентификаторов переписок, которые нужно обработать
+        exclude (set): Множество идентификаторов переписок, которые не нужно обрабатывать
+        compress (bool): Сжимать ли JSON сообщений и пользователей
+    """
+    # Получаем идентификаторы всех скачанных переписок
+    peer_ids = {int(file.name.rstrip('.sqlite')) for file in out_dir.glob('.sqlite/*.sqlite')}
+
+    # Выбираем нужные переписки
+    if include:
+        peer_ids &= include
+    elif exclude:
+        peer_ids -= exclude
+
+    log.debug(f"Peers: {', '.join(map(str, peer_ids))}")
+
+    processed = 0
+    size_before = size_after = 0
+
+    for peer_id in peer_ids:
+        log.debug(f'Processing peer {peer_id}')
 
         print(f'{round(processed / len(peer_ids) * 100)}%', end='\r')
 
-        peer = peers.Peer(session)
-        saver.save(out_dir, fmt, peer)
+        path = out_dir / f'.sqlite/{peer_id}.sqlite'
+        size_before += db.size(path)
+
+        db.convert(path, compress)
+        size_after += db.size(path)
 
         processed += 1
 
     print('100%')
+    print(f'Size: {size_before / (1 << 20):.1f} MiB -> {size_after / (1 << 20):.1f} MiB')
 
 
-def atch(out_dir, include, exclude, nthreads, types):
+def atch(out_dir, include, exclude, engine, nthreads, types, verify, dedup):
     """
     Скачивает вложения указанных переписок
 
@@ -198,8 +878,29 @@ def atch(out_dir, include, exclude, nthreads, types):
             результат работы программы
         include (set): Множество идентификаторов переписок, которые нужно обработать
         exclude (set): Множество идентификаторов переписок, которые не нужно обрабатывать
-        nthreads (int): Количество потоков, загружающих вложения
+        engine (str): Движок загрузки: `threads` (пул потоков) или `asyncio`
+        nthreads (int): Количество потоков, загружающих вложения (для движка `asyncio` -
+            кол-во одновременных загрузок)
+        types (set): Типы вложений, которые нужно загрузить
+        verify (bool): Вместо загрузки проверить целостность уже загруженных вложений
+        dedup (bool): Хранить одинаковые файлы один раз (в хранилище, адресуемом по
+            содержимому, с жесткими ссылками на него)
     """
+    # Манифест загруженных вложений, общий для всех переписок
+    manifest = attachments.Manifest(out_dir / '.state/attachments.sqlite')
+
+    if verify:
+        checked, missing, corrupted = attachments.verify(out_dir, manifest, nthreads)
+
+        print(f'Checked {checked} attachments: {len(missing)} missing, '
+              f'{len(corrupted)} corrupted')
+
+        if missing or corrupted:
+            print('Run `vkms atch` again to download them. '
+                  f"See logs for details: {out_dir / 'logs.txt'}")
+
+        return
+
     # Получаем идентификаторы всех скачанных переписок
     peer_ids = {int(file.name.rstrip('.sqlite')) for file in out_dir.glob('.sqlite/*.sqlite')}
 
@@ -211,8 +912,15 @@ def atch(out_dir, include, exclude, nthreads, types):
 
     log.debug(f"Peers: {', '.join(map(str, peer_ids))}")
 
+    if engine == 'asyncio':
+        asyncio.run(_atch_async(out_dir, peer_ids, nthreads, types, manifest, dedup))
+        return
+
     peer_ids_cnt = 0
 
+    # HTTP-сессия с пулом соединений, общая для всех переписок
+    http_session = net.create_session(nthreads)
+
     # Обрабатываем каждую переписку отдельно
     for peer_id in peer_ids:
         log.debug(f'Processing peer {peer_id}')
@@ -221,9 +929,41 @@ def atch(out_dir, include, exclude, nthreads, types):
 
         print(f'{round(peer_ids_cnt / len(peer_ids) * 100)}%', end='\r')
 
-        peer = peers.Peer(session)
-        attachments.download(out_dir, peer, nthreads, types)
+        try:
+            atchs = attachments.select_attachments(session, types)
+            attachments.download(out_dir, atchs, nthreads, http_session, manifest, dedup)
+
+        finally:
+            _close_peer(session)
 
         peer_ids_cnt += 1
 
     print('100%')
+
+
+async def _atch_async(out_dir, peer_ids, concurrency, types, manifest, dedup):
+    # Асинхронный вариант `atch`
+    from . import aio
+
+    peer_ids_cnt = 0
+
+    async with aio.create_session(concurrency) as http_session:
+        for peer_id in peer_ids:
+            log.debug(f'Processing peer {peer_id}')
+
+            session = db.connect(out_dir / f'.sqlite/{peer_id}.sqlite')
+
+            print(f'{round(peer_ids_cnt / len(peer_ids) * 100)}%', end='\r')
+
+            try:
+                atchs = attachments.select_attachments(session, types)
+                await attachments.download_async(
+                    out_dir, atchs, concurrency, http_session, manifest, dedup
+                )
+
+            finally:
+                _close_peer(session)
+
+            peer_ids_cnt += 1
+
+    print('100%')
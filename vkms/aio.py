@@ -0,0 +1,188 @@
+import asyncio
+import logging
+
+import aiohttp
+from vk.exceptions import VkAPIError
+from vk.utils import stringify_values
+
+from .api import execute_code
+from .utils import chunks
+
+log = logging.getLogger(__name__)
+
+# Ошибки сети, при которых загрузку можно повторить позже
+NETWORK_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError)
+
+
+def create_session(limit, timeout=None):
+    """
+    Создает асинхронную HTTP-сессию с пулом соединений. Должна создаваться внутри
+    запущенного цикла событий
+
+    Args:
+        limit (int): Максимальное кол-во одновременно открытых соединений
+        timeout (Union[float, None]): Максимальное время (в секундах) выполнения одного
+            запроса. Если `None`, время не ограничено (например, для больших вложений), но
+            установление соединения и ожидание очередной порции данных все равно ограничены
+
+    Returns:
+        aiohttp.ClientSession: HTTP-сессия с пулом соединений
+    """
+    return aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=limit, limit_per_host=limit),
+        timeout=aiohttp.ClientTimeout(total=timeout, sock_connect=10, sock_read=60)
+    )
+
+
+class AsyncAPI:
+    """
+    Асинхронный объект для работы с VK API. Используется как асинхронный контекстный
+    менеджер, методы вызываются так же, как у `vk.API`, но возвращают корутины:
+    `await api.messages.getHistory(peer_id=...)`
+
+    Все запросы проходят через общий ограничитель частоты, а одновременно выполняется
+    не более `concurrency` запросов. Остальные ждут своей очереди, а не открывают
+    новые соединения
+
+    Args:
+        access_token (str): Токен доступа к VK API
+        rate_limiter (RateLimiter): Ограничитель частоты запросов
+        concurrency (int): Максимальное кол-во одновременно выполняемых запросов
+        timeout (float): Максимальное время (в секундах) выполнения одного запроса
+        api_url (str): Адрес, к которому добавляется название метода (например, адрес
+            тестового сервера)
+        **kwargs: Параметры, передаваемые в каждом запросе (например, `v`)
+    """
+
+    API_URL = 'https://api.vk.com/method/'
+
+    def __init__(
+        self, access_token, rate_limiter, concurrency, timeout=10, api_url=API_URL, **kwargs
+    ):
+        self.access_token = access_token
+        self.rate_limiter = rate_limiter
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.api_url = api_url
+        self.params = kwargs
+
+        self.session = None
+        self._semaphore = None
+
+    async def __aenter__(self):
+        self.session = create_session(self.concurrency, self.timeout)
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        return self
+
+    async def __aexit__(self, *exc_info):  # noqa: U100
+        await self.session.close()
+
+    def __getattr__(self, name):
+        return _Method(self, name)
+
+    def __call__(self, method):
+        return _Method(self, method)
+
+    async def send(self, method, params):
+        """
+        Вызывает метод VK API. Ошибка 6 приводит к снижению частоты запросов и повтору,
+        при ошибке 14 (капча) запрашивается ее решение
+
+        Args:
+            method (str): Название метода VK API
+            params (dict): Параметры вызова метода
+
+        Returns:
+            Any: Ответ VK API
+        """
+        params = {**self.params, **stringify_values(params), 'access_token': self.access_token}
+
+        while True:
+            await asyncio.sleep(self.rate_limiter.reserve())
+
+            async with self._semaphore:
+                async with self.session.post(self.api_url + method, data=params) as r:
+                    r.raise_for_status()
+                    res = await r.json(content_type=None)
+
+            if 'response' in res:
+                for error_data in res.get('execute_errors', ()):
+                    api_error = VkAPIError(error_data)
+                    log.warning(f'Execute "{api_error.method}" error: {api_error}')
+
+                return res['response']
+
+            api_error = VkAPIError(res['error'])
+            log.error(f'Handle API error: {api_error}')
+
+            if api_error.code == 6:
+                # Лимит все равно превышен: замедляем все запросы и повторяем этот
+                self.rate_limiter.slow_down()
+
+            elif api_error.code == 14:
+                # Ввод решения капчи блокирует поток, поэтому выполняется отдельно
+                params['captcha_key'] = await asyncio.get_running_loop().run_in_executor(
+                    None, input, f'Captcha needed ({api_error.captcha_img}): '
+                )
+                params['captcha_sid'] = api_error.captcha_sid
+
+            else:
+                raise api_error
+
+    def submit(self, method, calls, execute):
+        """
+        Запускает вызовы метода VK API. Аналог `api.submit` для асинхронного движка
+
+        Args:
+            method (str): Название метода VK API
+            calls (list): Параметры каждого вызова метода
+            execute (bool): Упаковывать ли вызовы в запросы `execute`
+
+        Returns:
+            List[asyncio.Task]: Задачи, результат каждой - список ответов на вызовы
+                (в том же порядке, что и параметры)
+        """
+        if execute:
+            return [
+                asyncio.ensure_future(self._execute(method, batch))
+                for batch in chunks(calls, 25)
+            ]
+
+        return [asyncio.ensure_future(self._call(method, params)) for params in calls]
+
+    async def _call(self, method, params):
+        return [await self.send(method, params)]
+
+    async def _execute(self, method, calls):
+        try:
+            results = await self.send('execute', {'code': execute_code(method, calls)})
+        except VkAPIError as e:
+            # Ошибка 13 возникает, в том числе, если ответ оказался слишком большим.
+            # В таком случае разбиваем вызовы на две части
+            if e.code != 13 or len(calls) == 1:
+                raise
+
+            middle = len(calls) // 2
+            return (
+                await self._execute(method, calls[:middle])
+                + await self._execute(method, calls[middle:])
+            )
+
+        # Неудавшиеся вызовы повторяем по отдельности
+        return [
+            await self.send(method, params) if result is False else result
+            for result, params in zip(results, calls)
+        ]
+
+
+class _Method:
+    # Позволяет обращаться к методам VK API через точку: `api.messages.getHistory`
+    def __init__(self, api, name):
+        self._api = api
+        self._name = name
+
+    def __getattr__(self, name):
+        return _Method(self._api, f'{self._name}.{name}')
+
+    def __call__(self, **params):
+        return self._api.send(self._name, params)
@@ -0,0 +1,174 @@
+import logging
+from json import dumps
+from threading import Lock
+from time import monotonic, sleep
+
+import vk
+from vk.exceptions import VkAPIError
+
+from .utils import chunks
+
+log = logging.getLogger(__name__)
+
+
+class RateLimiter:
+    """
+    Ограничитель частоты запросов к VK API, основанный на алгоритме "token bucket".
+    Один объект используется всеми потоками: каждый запрос забирает из корзины токен,
+    а токены пополняются с постоянной скоростью. Если токенов нет, поток ждет своей
+    очереди, а не получает ошибку 6
+
+    Если ошибка 6 все же возникает (например, токен используется еще где-то), скорость
+    снижается вдвое, а затем постепенно возвращается к заданной
+
+    Args:
+        rate (float): Максимальное количество запросов в секунду
+    """
+
+    # Время (в секундах), за которое скорость восстанавливается от нуля до максимальной
+    recovery_time = 30
+
+    def __init__(self, rate):
+        if rate <= 0:
+            raise ValueError('Rate must be positive')
+
+        self.max_rate = rate
+        self.rate = rate
+
+        self._tokens = 1
+        self._updated = monotonic()
+        self._lock = Lock()
+
+    def acquire(self):
+        """
+        Забирает токен из корзины, при необходимости дожидаясь его появления
+        """
+        delay = self.reserve()
+
+        if delay > 0:
+            sleep(delay)
+
+    def reserve(self):
+        """
+        Забирает токен из корзины, не дожидаясь его появления. Используется асинхронным
+        движком, которому нельзя блокировать поток
+
+        Returns:
+            float: Время (в секундах), через которое можно отправить запрос
+        """
+        with self._lock:
+            now = monotonic()
+            elapsed = now - self._updated
+            self._updated = now
+
+            # Постепенно возвращаемся к максимальной скорости
+            self.rate = min(self.rate + elapsed * self.max_rate / self.recovery_time, self.max_rate)
+
+            # Пополняем корзину. Ее емкость - один токен, чтобы запросы не отправлялись
+            # пачками. Отрицательное кол-во токенов - очередь из ожидающих потоков
+            self._tokens = min(self._tokens + elapsed * self.rate, 1) - 1
+
+            return -self._tokens / self.rate
+
+    def slow_down(self):
+        """
+        Снижает скорость отправки запросов (вызывается при ошибке VK API 6)
+        """
+        with self._lock:
+            self.rate = max(self.rate / 2, self.max_rate / 10)
+
+            # Опустошаем корзину, чтобы следующие запросы подождали
+            self._tokens = min(self._tokens, 0)
+
+            log.warning(f'Too many requests, rate limit is lowered to {self.rate:.2f} r/s')
+
+
+class API(vk.API):
+    """
+    Объект для работы с VK API. Все запросы проходят через общий ограничитель частоты
+
+    Args:
+        access_token (str): Токен доступа к VK API
+        rate_limiter (RateLimiter): Ограничитель частоты запросов
+        session (requests.Session): HTTP-сессия с пулом соединений (см. `net.create_session`)
+    """
+
+    def __init__(self, access_token, rate_limiter, session, **kwargs):
+        super().__init__(access_token, **kwargs)
+        self.rate_limiter = rate_limiter
+
+        # Заменяем сессию, созданную библиотекой vk, на общую
+        session.headers.update(self.session.headers)
+        self.session = session
+
+    def send(self, request):
+        self.rate_limiter.acquire()
+        return super().send(request)
+
+    def on_api_error_6(self, request):
+        # Лимит все равно превышен: замедляем все потоки и повторяем запрос
+        self.rate_limiter.slow_down()
+        return self.send(request)
+
+    def get_captcha_key(self, api_error):
+        return input(f'Captcha needed ({api_error.captcha_img}): ')
+
+
+def submit(executor, api, method, calls, execute):
+    """
+    Отправляет вызовы метода VK API в пул потоков. В режиме `execute` до 25 вызовов
+    упаковываются в один запрос, что сокращает кол-во обращений к VK API
+
+    Args:
+        executor (ThreadPoolExecutor): Пул потоков, в котором выполняются запросы к VK API
+        api (vk.API): Объект, через который происходит обращение к методам VK API
+        method (str): Название метода VK API
+        calls (list): Параметры каждого вызова метода
+        execute (bool): Упаковывать ли вызовы в запросы `execute`
+
+    Returns:
+        List[Future]: Задачи, результат каждой - список ответов на вызовы (в том же
+            порядке, что и параметры)
+    """
+    if execute:
+        return [executor.submit(_execute, api, method, batch) for batch in chunks(calls, 25)]
+
+    return [executor.submit(_call, api, method, params) for params in calls]
+
+
+def _call(api, method, params):
+    return [api(method)(**params)]
+
+
+def execute_code(method, calls):
+    """
+    Формирует код на VKScript, который возвращает массив ответов на все вызовы
+
+    Args:
+        method (str): Название метода VK API
+        calls (list): Параметры каждого вызова метода
+
+    Returns:
+        str: Код для метода `execute`
+    """
+    return 'return [{}];'.format(','.join(f'API.{method}({dumps(params)})' for params in calls))
+
+
+def _execute(api, method, calls):
+    try:
+        results = api.execute(code=execute_code(method, calls))
+    except VkAPIError as e:
+        # Ошибка 13 возникает, в том числе, если ответ оказался слишком большим.
+        # В таком случае разбиваем вызовы на две части
+        if e.code != 13 or len(calls) == 1:
+            raise
+
+        middle = len(calls) // 2
+        return _execute(api, method, calls[:middle]) + _execute(api, method, calls[middle:])
+
+    # Неудавшиеся вызовы (например, из-за ошибки 6) повторяем по отдельности,
+    # чтобы ошибка была обработана обычным образом
+    return [
+        api(method)(**params) if result is False else result
+        for result, params in zip(results, calls)
+    ]
@@ -1,4 +1,5 @@
 from argparse import ArgumentParser, RawDescriptionHelpFormatter
+from importlib.util import find_spec
 from os import getenv
 from pathlib import Path
 
@@ -108,7 +109,44 @@ def parse_args():
         '--threads',
         type=int,
         default=2,
-        help='Number of threads to download peers, defaults to 2'
+        help='Number of threads to download peers, defaults to 2. '
+             'With the asyncio engine, the number of simultaneous VK API requests'
+    )
+    parser_dump.add_argument(
+        '--engine',
+        choices=('threads', 'asyncio'),
+        default='threads',
+        help='Download engine: thread pools or asyncio coroutines (requires aiohttp). '
+             'Defaults to threads'
+    )
+    parser_dump.add_argument(
+        '--rps',
+        type=float,
+        default=3,
+        help='Maximum number of VK API requests per second (shared by all threads), '
+             'defaults to 3. The rate is lowered automatically if VK still rejects requests'
+    )
+    parser_dump.add_argument(
+        '-x',
+        '--execute',
+        action='store_true',
+        help='Pack up to 25 VK API calls into one "execute" request. '
+             'Reduces the number of requests on large peers'
+    )
+    parser_dump.add_argument(
+        '--profiles-ttl',
+        metavar='DAYS',
+        type=float,
+        default=7,
+        help='Number of days during which users and groups from the shared cache are '
+             'considered up to date, defaults to 7. Pass 0 to always re-download them'
+    )
+    parser_dump.add_argument(
+        '-z',
+        '--compress',
+        action='store_true',
+        help='Store messages and users compressed (zlib). Reduces the size of the database '
+             'several times. Use the "convert" action to compress already saved peers'
     )
     parser_dump.add_argument(
         '--export-json',
@@ -133,6 +171,59 @@ def parse_args():
         help='An easy-to-read format in which received messages must be '
              'converted. Supported formats: %(choices)s'
     )
+    parser_parse.add_argument(
+        '-j',
+        '--jobs',
+        type=int,
+        default=1,
+        help='Number of processes converting peers in parallel, defaults to 1. '
+             'Each peer is converted in one process'
+    )
+    parser_parse.add_argument(
+        '--pages',
+        dest='paginate',
+        metavar='BY',
+        type=lambda x: x if x == 'month' else int(x),
+        help='Split each HTML peer into pages: "month" - one page per month, a number - '
+             'that many messages per page. Pages are saved to a folder with an index.html'
+    )
+
+    parser_search = subparsers.add_parser(
+        'search',
+        help='Search saved messages by text (including forwarded messages and replies)',
+        formatter_class=CustomHelpFormatter,
+        description=description,
+        epilog=epilog
+    )
+
+    parser_search.add_argument(
+        'query',
+        nargs='+',
+        help='Words that must occur in the message. A word ending with "*" matches any word '
+             'starting with it'
+    )
+    parser_search.add_argument(
+        '-n',
+        '--limit',
+        type=int,
+        default=20,
+        help='Maximum number of messages to show, defaults to 20'
+    )
+
+    parser_convert = subparsers.add_parser(
+        'convert',
+        help='Compress (or decompress) already saved peers',
+        formatter_class=CustomHelpFormatter,
+        description=description,
+        epilog=epilog
+    )
+
+    parser_convert.add_argument(
+        '-d',
+        '--decompress',
+        action='store_true',
+        help='Store messages and users as plain JSON instead of compressing them'
+    )
 
     parser_atch = subparsers.add_parser(
         'atch',
@@ -147,7 +238,15 @@ def parse_args():
         '--threads',
         type=int,
         default=8,
-        help='Number of threads to download attachments, defaults to 8'
+        help='Number of threads to download attachments, defaults to 8. '
+             'With the asyncio engine, the number of simultaneous downloads'
+    )
+    parser_atch.add_argument(
+        '--engine',
+        choices=('threads', 'asyncio'),
+        default='threads',
+        help='Download engine: thread pool or asyncio coroutines (requires aiohttp). '
+             'Defaults to threads'
     )
     parser_atch.add_argument(
         '--ts',
@@ -158,6 +257,18 @@ def parse_args():
              'Available options: photos, docs, stickers, gifts, audios, graffiti. '
              'Defaults to all types of attachments'
     )
+    parser_atch.add_argument(
+        '--verify',
+        action='store_true',
+        help='Instead of downloading, re-hash already downloaded attachments to find missing '
+             'and corrupted files. They are removed, so the next run downloads them again'
+    )
+    parser_atch.add_argument(
+        '--dedup',
+        action='store_true',
+        help='Store identical files once: attachment files become hard links to a '
+             'content-addressed store, and already downloaded URLs are not downloaded again'
+    )
 
     args = parser.parse_args()
 
@@ -172,4 +283,25 @@ def parse_args():
 
         args.token = token
 
+    if getattr(args, 'jobs', 1) < 1:
+        parser.error('The -j/--jobs argument must be a positive number')
+
+    if getattr(args, 'threads', 1) < 1:
+        parser.error('The -t/--threads argument must be a positive number')
+
+    if getattr(args, 'rps', 1) <= 0:
+        parser.error('The --rps argument must be a positive number')
+
+    if getattr(args, 'paginate', None) is not None:
+        if args.fmt != 'html':
+            parser.error('The --pages argument requires the html format (-f html)')
+
+        if args.paginate != 'month' and args.paginate < 1:
+            parser.error('The --pages argument must be "month" or a positive number')
+
+    if getattr(args, 'engine', None) == 'asyncio' and find_spec('aiohttp') is None:
+        parser.error(
+            'The asyncio engine requires aiohttp. Install it with: pip install vkms[async]'
+        )
+
     return args
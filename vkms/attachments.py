@@ -1,51 +1,423 @@
+import asyncio
+import datetime
+import hashlib
 import logging
 import os
 from collections import deque
-from concurrent.futures import ThreadPoolExecutor, wait
+from concurrent.futures import (FIRST_COMPLETED, ThreadPoolExecutor,
+                                as_completed, wait)
+from contextlib import contextmanager
 from operator import itemgetter
 
 from pathvalidate import sanitize_filename
-from requests import get
 from requests.exceptions import RequestException
+from sqlalchemy import func, select
+
+from . import database as db
+from .utils import chunks
 
 log = logging.getLogger(__name__)
 
+# Таймауты загрузки вложения в секундах: установление соединения и ожидание очередной
+# порции данных (общее время загрузки большого файла не ограничено)
+TIMEOUT = (10, 60)
+
+# Размер порции, которой вложение записывается на диск
+CHUNK_SIZE = 1 << 20
+
+# Результаты проверки ответа сервера (см. `FileAttachment._check_response`): загрузку
+# нужно повторить или вложение нужно пропустить
+RETRY = object()
+SKIP = object()
+
+
+def index(session, msgs_json):
+    """
+    Добавляет скачиваемые вложения сообщений (в том числе пересланных и ответов) в
+    таблицу `attachments`
+
+    Args:
+        session (sqlalchemy.orm.Session): Сессия БД переписки (или соединение)
+        msgs_json (list): Объекты сообщений
+    """
+    rows = [
+        {
+            'msg_id': msg_json['id'],
+            'type': atch.tp,
+            'owner_id': atch.owner_id,
+            'atch_id': atch.id,
+            'url': atch.url,
+            'filename': atch.filename,
+            'size': atch.size
+        }
+        for msg_json in msgs_json for atch in _collect(msg_json)
+    ]
+
+    if rows:
+        session.execute(db.Attachment.__table__.insert(), rows)
+
+
+def select_attachments(session, types):
+    """
+    Выбирает вложения указанных типов из таблицы `attachments`
+
+    Args:
+        session (sqlalchemy.orm.Session): Открытая сессия к БД нужной переписки
+        types (set): Типы вложений, которые нужно загрузить
+
+    Yields:
+        FileAttachment: Вложение
+    """
+    tps = [cls.tp for cls, name in class_to_name.items() if name in types]
+    table = db.Attachment.__table__
+
+    # Одно и то же вложение может встречаться в нескольких сообщениях, но загружать
+    # каждый файл нужно один раз (иначе загрузки будут писать в один `.part`-файл).
+    # Из записей одного файла берем запись с максимальным `id`, т.е. самую свежую ссылку
+    number = func.row_number().over(
+        partition_by=(table.c.type, table.c.filename), order_by=table.c.id.desc()
+    )
+    numbered = select(table, number.label('number')).where(table.c.type.in_(tps)).subquery()
+    query = select(numbered).where(numbered.c.number == 1)
+
+    for row in session.execute(query).yield_per(5000):
+        yield FileAttachment.from_row(row)
 
-def download(out_dir, peer, nthreads, types):
+
+def download(out_dir, atchs, nthreads, session, manifest, dedup):
     """
-    Скачивает указанные переписки в формате JSON (результаты обращений к VK API)
+    Скачивает вложения. Вложения выбираются из итератора по мере освобождения потоков,
+    поэтому в памяти находится не более `2 * nthreads` ожидающих загрузок, сколько бы
+    вложений ни было в переписке. Вложения из манифеста пропускаются без обращения к
+    файловой системе, а загруженные - добавляются в него
 
     Args:
         out_dir (str): Абсолютный путь к каталогу, в котором находится
             результат работы программы
-        peer (peers.Peer): Объект переписки
+        atchs (Iterable[FileAttachment]): Вложения (см. `select_attachments`)
         nthreads (int): Количество потоков, загружающих вложения
+        session (requests.Session): HTTP-сессия с пулом соединений (см. `net.create_session`)
+        manifest (Manifest): Манифест загруженных вложений
+        dedup (bool): Хранить одинаковые файлы один раз (см. `_store`)
     """
     # Создаем папку для хранения вложений
     (out_dir / 'attachments').mkdir(parents=True, exist_ok=True)
 
-    # Обход сообщений в ширину
-    queue = deque(peer.msgs)
+    atchs = _not_downloaded(out_dir, atchs, manifest, dedup)
 
     with ThreadPoolExecutor(nthreads, 'Thread-') as executor:
-        tasks = []
+        for atch, downloaded in _run_bounded(
+            executor, 2 * nthreads, lambda atch: atch.download(out_dir, session), atchs
+        ):
+            if downloaded:
+                _save(out_dir, atch, manifest, dedup)
+
+    manifest.commit()
+
+
+async def download_async(out_dir, atchs, nthreads, session, manifest, dedup):
+    """
+    Асинхронный вариант `download`. Вложения скачивают `nthreads` обработчиков, каждый из
+    которых берет из итератора следующее вложение, когда завершает предыдущее
+
+    Args:
+        out_dir (str): Абсолютный путь к каталогу, в котором находится
+            результат работы программы
+        atchs (Iterable[FileAttachment]): Вложения (см. `select_attachments`)
+        nthreads (int): Максимальное кол-во одновременно загружаемых вложений
+        session (aiohttp.ClientSession): HTTP-сессия с пулом соединений (см.
+            `aio.create_session`)
+        manifest (Manifest): Манифест загруженных вложений
+        dedup (bool): Хранить одинаковые файлы один раз (см. `_store`)
+    """
+    (out_dir / 'attachments').mkdir(parents=True, exist_ok=True)
+
+    # Итератор общий для всех обработчиков. Цикл событий однопоточный, поэтому
+    # следующее вложение всегда получает только один из них
+    atchs = _not_downloaded(out_dir, atchs, manifest, dedup)
+
+    async def worker():
+        for atch in atchs:
+            if await atch.download_async(out_dir, session):
+                _save(out_dir, atch, manifest, dedup)
+
+    await asyncio.gather(*(worker() for _ in range(nthreads)))
+
+    manifest.commit()
+
+
+def verify(out_dir, manifest, nthreads):
+    """
+    Проверяет целостность загруженных вложений: заново вычисляет контрольные суммы
+    всех файлов из манифеста. Отсутствующие и поврежденные файлы удаляются из
+    манифеста (поврежденные - и с диска), поэтому будут загружены заново. Поврежденные
+    файлы хранилища `.store` (см. `_store`) тоже удаляются
+
+    Args:
+        out_dir (str): Абсолютный путь к каталогу, в котором находится
+            результат работы программы
+        manifest (Manifest): Манифест загруженных вложений
+        nthreads (int): Количество потоков, проверяющих файлы
+
+    Returns:
+        Tuple[int, list, list]: Кол-во проверенных файлов, пути к отсутствующим и
+            поврежденным файлам (относительно каталога `attachments`)
+    """
+    def check(entry):
+        # Возвращает `True`, если файл не поврежден, `False` - если поврежден,
+        # и `None`, если файла нет
+        path = out_dir / 'attachments' / entry.path
+
+        if not path.exists():
+            return None
+
+        return path.stat().st_size == entry.size and _sha256(path) == entry.sha256
+
+    def check_stored(path):
+        # Файл хранилища называется контрольной суммой своего содержимого
+        return _sha256(path) == path.name
+
+    checked, missing, corrupted = 0, [], []
+    store = out_dir / 'attachments' / '.store'
+
+    with ThreadPoolExecutor(nthreads, 'Thread-') as executor:
+        for entry, ok in _run_bounded(executor, 2 * nthreads, check, manifest.entries()):
+            checked += 1
+
+            if ok is None:
+                log.warning(f'Attachment {entry.path} is missing')
+                missing.append(entry.path)
+
+            elif not ok:
+                log.warning(f'Attachment {entry.path} is corrupted')
+                corrupted.append(entry.path)
+
+        manifest.remove(missing + corrupted)
+
+        # Иначе поврежденный файл хранилища будет связан с вложением при повторной загрузке
+        for path, ok in _run_bounded(executor, 2 * nthreads, check_stored, store.glob('*/*')):
+            checked += 1
+
+            if not ok:
+                log.warning(f'Stored file {path.name} is corrupted')
+                corrupted.append(path.relative_to(out_dir / 'attachments').as_posix())
+
+    for path in corrupted:
+        (out_dir / 'attachments' / path).unlink(missing_ok=True)
+
+    return checked, missing, corrupted
+
+
+class Manifest:
+    """
+    Общий для всех переписок манифест загруженных вложений. Позволяет при повторном
+    запуске пропускать уже загруженные вложения, не обращаясь к файловой системе, и
+    проверять целостность файлов (см. `verify`). Используется только одним потоком
+
+    Args:
+        path (pathlib.Path): Путь к БД манифеста
+    """
+
+    def __init__(self, path):
+        self._session = db.connect(path, db.ManifestBase)
+        self._table = db.DownloadedFile.__table__
+        self._added = 0
+
+    def find_url(self, url):
+        """
+        Ищет загруженный файл по ссылке на загрузку
+
+        Args:
+            url (str): Ссылка на загрузку
+
+        Returns:
+            Union[Row, None]: Запись манифеста или `None`, если файл не найден
+        """
+        return self._session.execute(
+            self._table.select().where(self._table.c.url == url).limit(1)
+        ).first()
+
+    def __contains__(self, atch):
+        return self._session.execute(
+            select(self._table.c.path).where(self._table.c.path == atch.key)
+        ).first() is not None
+
+    def put(self, atch):
+        """
+        Добавляет загруженное вложение в манифест
+
+        Args:
+            atch (FileAttachment): Вложение, для которого вызван `describe`
+        """
+        self._session.execute(self._table.insert().prefix_with('OR REPLACE').values(
+            path=atch.key,
+            url=atch.url,
+            size=atch.size,
+            sha256=atch.sha256,
+            etag=atch.etag,
+            downloaded=datetime.datetime.now()
+        ))
+        self._added += 1
+
+        # Периодически сохраняем изменения, чтобы не потерять их при прерывании
+        if self._added % 1000 == 0:
+            self.commit()
+
+    def entries(self):
+        """
+        Yields:
+            Row: Записи манифеста (путь, размер, контрольная сумма, ETag, время загрузки)
+        """
+        yield from self._session.execute(self._table.select()).yield_per(5000)
+
+    def remove(self, paths):
+        """
+        Удаляет вложения из манифеста
+
+        Args:
+            paths (list): Пути к файлам (относительно каталога `attachments`)
+        """
+        for chunk in chunks(paths, 500):
+            self._session.execute(self._table.delete().where(self._table.c.path.in_(chunk)))
+
+        self.commit()
+
+    def commit(self):
+        self._session.commit()
+
+
+def _not_downloaded(out_dir, atchs, manifest, dedup):
+    # Пропускает вложения, которые уже есть в манифесте. При дедупликации вложение,
+    # ссылка на которое уже загружалась под другим именем, не загружается, а связывается
+    # с имеющимся файлом
+    for atch in atchs:
+        if atch in manifest:
+            continue
+
+        if dedup and atch.url:
+            entry = manifest.find_url(atch.url)
+
+            if entry is not None:
+                path = atch.get_path(out_dir)
+                path.parent.mkdir(parents=True, exist_ok=True)
+
+                if _link(out_dir / 'attachments' / entry.path, path):
+                    atch.size, atch.sha256, atch.etag = entry.size, entry.sha256, entry.etag
+                    manifest.put(atch)
+                    continue
+
+        yield atch
+
+
+def _save(out_dir, atch, manifest, dedup):
+    # Учитывает загруженное вложение
+    if dedup:
+        _store(out_dir, atch)
+
+    manifest.put(atch)
+
+
+def _store(out_dir, atch):
+    # Хранилище, адресуемое по содержимому: каждый уникальный файл хранится один раз
+    # в `attachments/.store/<sha256>`, а файлы вложений - жесткие ссылки на него
+    stored = out_dir / 'attachments' / '.store' / atch.sha256[:2] / atch.sha256
+    stored.parent.mkdir(parents=True, exist_ok=True)
+
+    if stored.exists():
+        # Файл в хранилище мог быть поврежден: тогда заменяем его только что загруженным,
+        # иначе повреждение распространится на все вложения с таким содержимым. Имя файла -
+        # уже вычисленная контрольная сумма, поэтому проверяется только размер (содержимое
+        # проверяет `verify`), и загрузка не тратит время на повторное чтение файла
+        if stored.stat().st_size != atch.size:
+            log.warning(f'Stored copy of {atch.key} is corrupted, replacing it')
+            _link(atch.get_path(out_dir), stored)
+            return
+
+        # Такой файл уже есть: заменяем копию ссылкой, освобождая место
+        _link(stored, atch.get_path(out_dir))
+        return
+
+    try:
+        os.link(atch.get_path(out_dir), stored)
+    except OSError as e:
+        log.warning(f'Failed to add {atch.key} to the attachment store: {e}')
+
+
+def _link(src, dst):
+    # Заменяет `dst` жесткой ссылкой на `src`. Возвращает `False`, если ссылку создать
+    # не удалось (например, файловая система их не поддерживает)
+    tmp = dst.with_name(dst.name + '.link')
+
+    try:
+        tmp.unlink(missing_ok=True)
+        os.link(src, tmp)
+    except OSError as e:
+        log.warning(f'Failed to link {dst.name} to {src.name}: {e}')
+        return False
+
+    os.replace(tmp, dst)
+    return True
+
+
+def _run_bounded(executor, limit, fn, items):
+    # Выполняет `fn` для каждого элемента в пуле потоков, держа в очереди не более
+    # `limit` задач. Возвращает пары (элемент, результат) по мере выполнения задач
+    pending = {}
+
+    for item in items:
+        # Очередь заполнена: ждем завершения хотя бы одной задачи
+        if len(pending) >= limit:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                yield pending.pop(future), future.result()
+
+        pending[executor.submit(fn, item)] = item
+
+    for future in as_completed(pending):
+        yield pending[future], future.result()
+
+
+def _sha256(path):
+    # Контрольная сумма файла (читается порциями, т.к. вложение может быть большим)
+    digest = hashlib.sha256()
+
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            digest.update(chunk)
 
-        while queue:
-            msg = queue.popleft()
+    return digest.hexdigest()
 
-            # Добавляем все скачиваемые вложения
-            for atch in msg.atchs:
-                if class_to_name.get(atch.__class__) in types:
-                    tasks.append(executor.submit(atch.download, out_dir))
 
-            # Если у сообщения есть пересланные, то добавляем их в очередь
-            if msg.fwd_msgs:
-                queue.extend(msg.fwd_msgs)
+def _size(path):
+    # Размер файла (0, если файла нет)
+    return path.stat().st_size if path.exists() else 0
 
-            if msg.reply_msg:
-                queue.append(msg.reply_msg)
 
-        wait(tasks)
+def _collect(msg_json):
+    # Обход сообщения и всех вложенных в него в ширину
+    queue = deque([msg_json])
+
+    while queue:
+        msg = queue.popleft()
+
+        # Добавляем все скачиваемые вложения
+        for atch_json in msg.get('attachments', ()):
+            # Вложение неожиданного формата пропускаем, чтобы не прерывать загрузку переписки
+            try:
+                atch = gen_attachment(atch_json)
+            except (KeyError, IndexError, TypeError, ValueError) as e:
+                log.warning(f"Skipping malformed attachment of message {msg.get('id')}: {e!r}")
+                continue
+
+            if isinstance(atch, FileAttachment):
+                yield atch
+
+        # Если у сообщения есть пересланные, то добавляем их в очередь
+        queue.extend(msg.get('fwd_messages', ()))
+
+        if 'reply_message' in msg:
+            queue.append(msg['reply_message'])
 
 
 class Attachment:
@@ -79,65 +451,333 @@ class FileAttachment(Attachment):
     # Имя файла, под которым вложение будет сохранено (уникальное для каждого вложения)
     filename = None
 
+    # Владелец и идентификатор вложения, размер файла в байтах (если известны)
+    owner_id = None
+    id = None
+    size = None
+
+    # Контрольная сумма и HTTP ETag загруженного файла (см. `describe`)
+    sha256 = None
+    etag = None
+
+    @staticmethod
+    def from_row(row):
+        """
+        Восстанавливает вложение по записи таблицы `attachments`, не разбирая JSON сообщения
+
+        Args:
+            row: Запись таблицы `attachments`
+
+        Returns:
+            FileAttachment: Вложение
+        """
+        atch = object.__new__(_attachments[row.type])
+
+        atch.url = row.url
+        atch.filename = row.filename
+        atch.owner_id = row.owner_id
+        atch.id = row.atch_id
+        atch.size = row.size
+
+        return atch
+
+    @property
+    def key(self):
+        # Путь к файлу относительно каталога `attachments` (ключ в манифесте)
+        return f'{self.pf_dir}/{self.filename}'
+
     def get_path(self, out_dir):
         return (out_dir / 'attachments' / self.pf_dir / self.filename).resolve()
 
-    def download(self, out_dir):
+    def describe(self, out_dir):
         """
-        Загружает и сохраняет вложение
+        Вычисляет контрольную сумму загруженного файла и его размер (если он не был
+        известен заранее)
 
         Args:
             out_dir (str): Абсолютный путь к каталогу, в котором находится
                 результат работы программы
         """
-        log.debug(f'Downloading attachment {self.tp}, {self.filename}')
+        path = self.get_path(out_dir)
 
-        if not self.url:
-            log.warning('Downloading attachment skipped: URL not specified')
-            return
+        if self.size is None:
+            self.size = path.stat().st_size
 
-        # Создаем папку для хранения вложений этого типа
-        (out_dir / 'attachments' / self.pf_dir).mkdir(parents=True, exist_ok=True)
+        self.sha256 = _sha256(path)
 
-        # Если файл уже скачан, пропускаем его
-        if os.path.exists(self.get_path(out_dir)):
-            return
+    def download(self, out_dir, session):
+        """
+        Загружает и сохраняет вложение. Файл загружается во временный `.part`-файл и
+        переименовывается только после полной загрузки. Если `.part`-файл остался от
+        прерванной загрузки, она продолжается с сохраненного места (заголовок `Range`)
 
+        Args:
+            out_dir (str): Абсолютный путь к каталогу, в котором находится
+                результат работы программы
+            session (requests.Session): HTTP-сессия, через которую загружается вложение
+
+        Returns:
+            bool: Загружен ли файл (в том числе ранее)
+        """
+        if not self._prepare(out_dir):
+            return False
+
+        # Файл уже скачан (например, до появления манифеста)
+        if self._downloaded(out_dir):
+            self.describe(out_dir)
+            return True
+
+        part = self.get_part_path(out_dir)
         attempts = 0
 
         # Есть 3 попытки для установления соединения
         # (если ошибка произошла на стороне сервера)
         while attempts < 3:
             try:
-                with get(self.url, stream=True) as r:
-                    if r.status_code >= 500:
+                with session.get(
+                    self.url, stream=True, headers=self._request_headers(part), timeout=TIMEOUT
+                ) as r:
+                    response = self._check_response(part, r.status_code, r.headers)
+
+                    if response is RETRY:
                         attempts += 1
                         continue
 
-                    # Если ошибка на нашей стороне - пропускаем это вложение
-                    elif r.status_code >= 400:
-                        log.error(
-                            'Downloading attachment failed: HTTP code %s. Url: %s',
-                            r.status_code, self.url
-                        )
-                        return
+                    elif response is SKIP:
+                        return False
+
+                    start, size = response
 
                     # Скачивание происходит порциями (чанками), т.к. максимальный
                     # размер вложения VK - 2ГБ
-                    with open(self.get_path(out_dir), 'wb') as file:
-                        for chunk in r.iter_content(chunk_size=(1 << 20) * 10):
-                            file.write(chunk)
-
-                        return
+                    if start is not None:
+                        with self._open_part(part, start) as file:
+                            for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                                file.write(chunk)
 
             except RequestException:
                 attempts += 1
+                continue
 
+            if self._finish(out_dir, size):
+                self.describe(out_dir)
+                return True
+
+            attempts += 1
+
+        self._log_failed()
+        return False
+
+    async def download_async(self, out_dir, session):
+        """
+        Асинхронный вариант `download`
+
+        Args:
+            out_dir (str): Абсолютный путь к каталогу, в котором находится
+                результат работы программы
+            session (aiohttp.ClientSession): HTTP-сессия, через которую загружается вложение
+
+        Returns:
+            bool: Загружен ли файл (в том числе ранее)
+        """
+        from .aio import NETWORK_ERRORS
+
+        if not self._prepare(out_dir):
+            return False
+
+        # Контрольная сумма вычисляется в отдельном потоке, чтобы не блокировать цикл событий
+        loop = asyncio.get_running_loop()
+
+        if self._downloaded(out_dir):
+            await loop.run_in_executor(None, self.describe, out_dir)
+            return True
+
+        part = self.get_part_path(out_dir)
+        attempts = 0
+
+        while attempts < 3:
+            try:
+                async with session.get(self.url, headers=self._request_headers(part)) as r:
+                    response = self._check_response(part, r.status, r.headers)
+
+                    if response is RETRY:
+                        attempts += 1
+                        continue
+
+                    elif response is SKIP:
+                        return False
+
+                    start, size = response
+
+                    if start is not None:
+                        with self._open_part(part, start) as file:
+                            async for chunk in r.content.iter_chunked(CHUNK_SIZE):
+                                file.write(chunk)
+
+            except NETWORK_ERRORS:
+                attempts += 1
+                continue
+
+            if self._finish(out_dir, size):
+                await loop.run_in_executor(None, self.describe, out_dir)
+                return True
+
+            attempts += 1
+
+        self._log_failed()
+        return False
+
+    def get_part_path(self, out_dir):
+        # Путь к временному файлу, в который загружается вложение
+        path = self.get_path(out_dir)
+        return path.with_name(path.name + '.part')
+
+    def _prepare(self, out_dir):
+        # Проверяет, можно ли загрузить вложение, и создает для него папку
+        log.debug(f'Downloading attachment {self.tp}, {self.filename}')
+
+        if not self.url:
+            log.warning('Downloading attachment skipped: URL not specified')
+            return False
+
+        # Создаем папку для хранения вложений этого типа
+        (out_dir / 'attachments' / self.pf_dir).mkdir(parents=True, exist_ok=True)
+
+        return True
+
+    def _check_response(self, part, status, headers):
+        # Разбирает ответ сервера (общая для обоих движков часть загрузки). Возвращает
+        # `RETRY`, если загрузку нужно повторить (ошибка на стороне сервера), `SKIP`, если
+        # вложение нужно пропустить (ошибка на нашей стороне), иначе результат
+        # `_content_range`
+        if status >= 500:
+            return RETRY
+
+        if status >= 400 and status != 416:
+            log.error('Downloading attachment failed: HTTP code %s. Url: %s', status, self.url)
+            return SKIP
+
+        self.etag = headers.get('ETag')
+
+        return self._content_range(part, status, headers)
+
+    @staticmethod
+    @contextmanager
+    def _open_part(part, start):
+        # Открывает `.part`-файл для записи ответа с указанного места. Если соединение
+        # оборвется, уже полученные данные сбрасываются на диск, чтобы загрузка
+        # продолжилась с них
+        part.touch()
+
+        with open(part, 'r+b') as file:
+            file.seek(start)
+            file.truncate()
+
+            try:
+                yield file
+            finally:
+                file.flush()
+
+    def _log_failed(self):
         log.error(
             'Downloading attachment failed: HTTP code > 500 or '
             'weak connection. Url: ' + self.url
         )
 
+    @staticmethod
+    def _request_headers(part):
+        # Заголовки запроса: если часть файла уже загружена, запрашиваем только остаток.
+        # Сжатие отключаем, чтобы размер ответа совпадал с `Content-Length`
+        headers = {'Accept-Encoding': 'identity'}
+
+        if _size(part):
+            headers['Range'] = f'bytes={_size(part)}-'
+
+        return headers
+
+    @staticmethod
+    def _content_range(part, status, headers):
+        # Определяет, с какого места записывать ответ в `.part`-файл и каким должен быть
+        # полный размер файла. Если ответ нельзя дописать к `.part`-файлу, удаляет его и
+        # возвращает `None` в качестве места
+        length = headers.get('Content-Length')
+
+        if status == 416:
+            # Загруженная часть больше файла на сервере
+            log.warning(f'Partial download {part.name} does not match the file, restarting')
+            part.unlink(missing_ok=True)
+            return None, None
+
+        if status != 206:
+            # Сервер не поддерживает `Range`: файл загружается целиком
+            return 0, int(length) if length is not None else None
+
+        # Content-Range: bytes <start>-<end>/<size>
+        unit, _, spec = headers.get('Content-Range', '').partition(' ')
+        spec, _, size = spec.partition('/')
+        start = spec.partition('-')[0]
+
+        # Сервер вернул не ту часть файла, которую можно дописать
+        if unit != 'bytes' or not start.isdigit() or int(start) > _size(part):
+            part.unlink(missing_ok=True)
+            return None, None
+
+        return int(start), int(size) if size.isdigit() else None
+
+    def _downloaded(self, out_dir):
+        # Проверяет файл, оставшийся от предыдущих запусков. Если его размер не совпадает
+        # с известным размером вложения (например, предыдущие версии VKMS прервали
+        # загрузку), файл считается `.part`-файлом, и загрузка продолжается с него
+        path = self.get_path(out_dir)
+
+        if not path.exists():
+            return False
+
+        actual = _size(path)
+
+        if self.size is None or actual == self.size:
+            return True
+
+        log.warning(f'File {path.name} has {actual} of {self.size} bytes, resuming')
+        part = self.get_part_path(out_dir)
+
+        # Незавершенная загрузка через `.part`-файл новее оставшегося файла
+        if part.exists():
+            path.unlink()
+        else:
+            os.replace(path, part)
+
+        return False
+
+    def _finish(self, out_dir, size):
+        # Переименовывает полностью загруженный `.part`-файл. Возвращает `False`, если
+        # загрузка не завершена. Если сервер не сообщил размер файла, используется
+        # размер, известный заранее
+        part = self.get_part_path(out_dir)
+
+        if not part.exists():
+            return False
+
+        actual = _size(part)
+
+        if size is None:
+            size = self.size
+
+        if size is not None and actual != size:
+            log.warning(f'Downloaded {actual} of {size} bytes of {part.name}, resuming')
+
+            # Файл больше ожидаемого - загружаем его заново
+            if actual > size:
+                part.unlink()
+
+            return False
+
+        os.replace(part, self.get_path(out_dir))
+
+        # Размер, известный заранее, может не совпадать с настоящим
+        self.size = actual
+        return True
+
 
 class Photo(FileAttachment):
     tp = 'photo'
@@ -147,6 +787,8 @@ class Photo(FileAttachment):
         if json.get('sizes'):
             self.url = max(json['sizes'], key=itemgetter('width', 'height'))['url']
 
+        self.owner_id = json['owner_id']
+        self.id = json['id']
         self.filename = f"{json['owner_id']}_{json['id']}.jpg"
 
 
@@ -173,6 +815,9 @@ class Document(FileAttachment):
 
     def __init__(self, json):
         self.url = json['url']
+        self.owner_id = json['owner_id']
+        self.id = json['id']
+        self.size = json.get('size')
         self.filename = sanitize_filename(
             f"{json['title']}_{json['owner_id']}_{json['id']}.{json['ext']}",
             replacement_text='_'
@@ -210,6 +855,7 @@ class Sticker(FileAttachment):
 
     def __init__(self, json):
         self.url = max(json['images'], key=itemgetter('width', 'height'))['url']
+        self.id = json['sticker_id']
         self.filename = f"{json['product_id']}_{json['sticker_id']}.png"
 
 
@@ -219,6 +865,7 @@ class Gift(FileAttachment):
 
     def __init__(self, json):
         self.url = json['thumb_256']
+        self.id = json['id']
         self.filename = f"{json['id']}.jpg"
 
 
@@ -228,6 +875,8 @@ class AudioMessage(FileAttachment):
 
     def __init__(self, json):
         self.url = json['link_mp3']
+        self.owner_id = json['owner_id']
+        self.id = json['id']
         self.filename = f"{json['owner_id']}_{json['id']}.mp3"
 
 
@@ -237,6 +886,8 @@ class Graffiti(FileAttachment):
 
     def __init__(self, json):
         self.url = json['url']
+        self.owner_id = json['owner_id']
+        self.id = json['id']
         self.filename = f"{json['owner_id']}_{json['id']}.png"
 
 
@@ -1,8 +1,93 @@
 import datetime
+import logging
+import zlib
+from collections import deque
+from json import dumps, loads
 
-from sqlalchemy import JSON, Column, DateTime, Integer, create_engine
+from sqlalchemy import (JSON, Boolean, Column, DateTime, Integer, Text,
+                        bindparam, create_engine, event, func, inspect, select,
+                        text)
 from sqlalchemy.orm import declarative_base, sessionmaker
 
+log = logging.getLogger(__name__)
+
+# Битовые флаги типов вложений (см. `Message.atch_flags`). Значения хранятся в БД,
+# поэтому новые типы можно добавлять только в конец
+ATCH_FLAGS = {tp: 1 << i for i, tp in enumerate((
+    'photo', 'video', 'audio', 'doc', 'link', 'wall', 'wall_reply', 'sticker', 'gift',
+    'audio_message', 'graffiti', 'call', 'poll'
+))}
+
+# Предустановленный словарь для сжатия JSON: часто встречающиеся в объектах VK API
+# фрагменты (самые частые - в конце). Сжатые значения ссылаются на него, поэтому
+# словарь нельзя изменять - только добавить новый формат (см. `_json_formats`)
+_zdict_v1 = ''.join((
+    '"can_access_closed":true,"is_closed":false,"deactivated":"deleted",',
+    '"screen_name":"club","type":"page","photo_50":"https://sun1-1.userapi.com/s/v1/ig2/',
+    '"photo_100":"","photo_200":"","first_name":"","last_name":"","name":"',
+    '"action":{"type":"chat_invite_user","member_id":"chat_kick_user","chat_title_update",',
+    '"geo":{"type":"point","coordinates":{"latitude":,"longitude":},"place":{"title":"',
+    '"type":"call","call":{"initiator_id":,"receiver_id":,"state":"reached","time":,',
+    '"duration":,"video":false},"type":"poll","poll":{"question":"","answers":[',
+    '"type":"link","link":{"url":"https://","title":"","caption":"","description":"',
+    '"type":"wall","wall":{"from_id":,"to_id":,"type":"sticker","sticker":{"product_id":',
+    '"sticker_id":,"images":[{"url":"https://vk.com/sticker/1-","width":128,"height":128},',
+    '"images_with_background":[],"animation_url":"","is_allowed":true},',
+    '"type":"audio_message","audio_message":{"duration":,"waveform":[],',
+    '"link_ogg":"https://psv4.userapi.com/c","link_mp3":"https://psv4.userapi.com/c",',
+    '"transcript_state":"done","transcript":"","type":"doc","doc":{"title":"","size":,',
+    '"ext":"jpg","type":4,"url":"https://vk.com/doc","preview":{"photo":{"sizes":[',
+    '"type":"video","video":{"title":"","duration":,"image":[{"url":"https://sun9-',
+    '"first_frame":[{"url":"https://sun9-","views":,"local_views":,"platform":"',
+    '"reply_message":{"fwd_messages":[{"update_time":,"is_expired":true,',
+    '"random_id":0,"important":false,"is_hidden":false,"out":0,"out":1,',
+    '"ref":"","ref_source":"","admin_author_id":,"is_unavailable":true,',
+    '"photo":{"album_id":-3,"date":,"id":,"owner_id":,"access_key":"","post_id":,',
+    '"has_tags":false,"text":"","web_view_token":"","square_crop":"",',
+    '"sizes":[{"height":75,"type":"s","width":75,"url":"https://sun9-1.userapi.com/impg/',
+    '.jpg?size=75x75&quality=96&sign=&c_uniq_tag=&type=album"},',
+    '{"height":130,"type":"m","width":130,"url":"https://sun9-',
+    '{"height":604,"type":"x","width":604,"url":"https://sun9-',
+    '{"height":807,"type":"y","width":807,"url":"https://sun9-',
+    '{"height":1080,"type":"z","width":1080,"url":"https://sun9-',
+    '{"height":2560,"type":"w","width":2560,"url":"https://sun9-',
+    '"type":"o","type":"p","type":"q","type":"r","userapi.com/impg/',
+    '"attachments":[{"type":"photo","photo":{',
+    '{"date":16,"from_id":,"id":,"out":0,"attachments":[],"conversation_message_id":',
+    '"fwd_messages":[],"important":false,"is_hidden":false,"peer_id":2000000',
+    '"random_id":0,"text":""}'
+)).encode()
+
+
+def _dumps_zlib_v1(obj):
+    # Сжимает JSON без заголовка zlib (deflate), используя предустановленный словарь
+    compressor = zlib.compressobj(9, zlib.DEFLATED, -15, zdict=_zdict_v1)
+    data = dumps(obj, ensure_ascii=False, separators=(',', ':')).encode()
+
+    return bytes((1,)) + compressor.compress(data) + compressor.flush()
+
+
+def _loads_zlib_v1(data):
+    decompressor = zlib.decompressobj(-15, zdict=_zdict_v1)
+    return loads(decompressor.decompress(data) + decompressor.flush())
+
+
+# Форматы сжатия JSON. Сжатое значение хранится в виде BLOB, первый байт которого -
+# номер формата, несжатое - в виде текста
+_json_formats = {
+    1: _loads_zlib_v1
+}
+
+
+def _loads(value):
+    # Читает JSON в любом формате, поэтому сжатые и несжатые значения могут храниться
+    # в одной БД
+    if isinstance(value, bytes):
+        return _json_formats[value[0]](value[1:])
+
+    return loads(value)
+
+
 Base = declarative_base()
 
 
@@ -19,14 +104,78 @@ class Message(Base):
 
     id = Column(Integer, primary_key=True, autoincrement=False)
     json = Column(JSON, nullable=False)
-    date = Column(DateTime, nullable=False)
+    date = Column(DateTime, nullable=False, index=True)
+
+    # Поля, извлеченные из JSON при сохранении, чтобы фильтровать сообщения, не
+    # разбирая JSON каждого из них
+    from_id = Column(Integer, index=True)
+    text = Column(Text)
+    conversation_message_id = Column(Integer)
+
+    # Типы вложений сообщения, в том числе пересланных и ответа (см. `ATCH_FLAGS`)
+    atch_flags = Column(Integer)
+
+    # Кол-во пересланных сообщений (без вложенных) и наличие ответа
+    fwd_count = Column(Integer)
+    has_reply = Column(Boolean)
 
     def __init__(self, json):
-        self.json = json
-        self.id = json['id']
-        self.date = datetime.datetime.fromtimestamp(json['date'])
+        Base.__init__(self, **self.values(json))
+
+    @staticmethod
+    def values(json):
+        # Значения столбцов записи (используются и при быстрой вставке, см. `insert`)
+        atch_flags = 0
+
+        # Обход сообщения и всех вложенных в него в ширину
+        queue = deque([json])
+
+        while queue:
+            msg = queue.popleft()
+
+            for atch in msg.get('attachments', ()):
+                atch_flags |= ATCH_FLAGS.get(atch['type'], 0)
+
+            queue.extend(msg.get('fwd_messages', ()))
 
-        Base.__init__(self)
+            if 'reply_message' in msg:
+                queue.append(msg['reply_message'])
+
+        return {
+            'id': json['id'],
+            'json': json,
+            'date': datetime.datetime.fromtimestamp(json['date']),
+            'from_id': json['from_id'],
+            'text': json.get('text', ''),
+            'conversation_message_id': json.get('conversation_message_id'),
+            'atch_flags': atch_flags,
+            'fwd_count': len(json.get('fwd_messages', ())),
+            'has_reply': 'reply_message' in json
+        }
+
+
+class Attachment(Base):
+    """
+    Скачиваемое вложение сообщения (в том числе пересланного или ответа). Записи
+    добавляются при сохранении сообщений (см. `attachments.index`), поэтому вложения
+    для загрузки выбираются одним запросом, без разбора JSON сообщений
+    """
+    __tablename__ = 'attachments'
+
+    id = Column(Integer, primary_key=True)
+    msg_id = Column(Integer, nullable=False, index=True)
+    type = Column(Text, nullable=False, index=True)
+
+    # Владелец и идентификатор вложения (если есть)
+    owner_id = Column(Integer)
+    atch_id = Column(Integer)
+
+    # Выбранная ссылка на загрузку (например, на фото наибольшего размера) и имя файла
+    url = Column(Text)
+    filename = Column(Text, nullable=False)
+
+    # Размер файла в байтах (если известен)
+    size = Column(Integer)
 
 
 class User(Base):
@@ -36,15 +185,503 @@ class User(Base):
     json = Column(JSON, nullable=False)
 
     def __init__(self, json):
-        self.json = json
-        self.id = -json['id'] if 'name' in json else json['id']
+        Base.__init__(self, **self.values(json))
 
-        Base.__init__(self)
+    @staticmethod
+    def values(json):
+        # Группы хранятся с отрицательными идентификаторами
+        return {'id': -json['id'] if 'name' in json else json['id'], 'json': json}
 
 
-def connect(path):
-    engine = create_engine(f'sqlite:///{path}', future=True)
-    Base.metadata.create_all(engine)
+class Progress(Base):
+    """
+    Контрольная точка незавершенной загрузки переписки. Запись существует, пока
+    загрузка не завершена, и позволяет продолжить ее с последнего сохраненного чанка
+    """
+    __tablename__ = 'progress'
+
+    id = Column(Integer, primary_key=True, autoincrement=False)
+
+    # Идентификатор сообщения, от которого отсчитываются смещения (`None` - от начала переписки)
+    start_msg_id = Column(Integer)
+
+    # Загружаемый диапазон смещений и кол-во уже сохраненных смещений этого диапазона
+    offset = Column(Integer, nullable=False)
+    count = Column(Integer, nullable=False)
+    done = Column(Integer, nullable=False, default=0)
+
+
+class SyncInfo(Base):
+    """
+    Метаданные синхронизации переписки. Обновляются вместе с каждой порцией сохраненных
+    сообщений, поэтому позволяют узнать последнее сообщение и кол-во сообщений, не
+    просматривая таблицу `messages`
+    """
+    __tablename__ = 'sync_info'
+
+    id = Column(Integer, primary_key=True, autoincrement=False)
+
+    # Последнее (самое новое) сохраненное сообщение
+    last_msg_id = Column(Integer)
+    last_msg_date = Column(DateTime)
+
+    msg_count = Column(Integer, nullable=False, default=0)
+
+    # Время последнего сохранения
+    synced = Column(DateTime)
+
+    def update(self, page):
+        """
+        Учитывает страницу сохраненных сообщений
+
+        Args:
+            page (list): Объекты сообщений, от старых к новым
+        """
+        if page:
+            self.last_msg_id = page[-1]['id']
+            self.last_msg_date = datetime.datetime.fromtimestamp(page[-1]['date'])
+            self.msg_count += len(page)
+
+        self.synced = datetime.datetime.now()
+
+
+# Общая для всех переписок БД с состоянием синхронизации
+StateBase = declarative_base()
+
+
+class PeerState(StateBase):
+    __tablename__ = 'peers'
+
+    id = Column(Integer, primary_key=True, autoincrement=False)
+
+    # Идентификатор последнего сохраненного сообщения переписки
+    last_msg_id = Column(Integer, nullable=False)
+
+
+# Общий для всех переписок кэш пользователей и групп
+CacheBase = declarative_base()
+
+
+class CachedUser(CacheBase):
+    __tablename__ = 'users'
+
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    json = Column(JSON, nullable=False)
+
+    # Время загрузки информации о пользователе
+    updated = Column(DateTime, nullable=False)
+
+
+# Общий для всех переписок манифест загруженных вложений
+ManifestBase = declarative_base()
+
+
+class DownloadedFile(ManifestBase):
+    __tablename__ = 'files'
+
+    # Путь к файлу относительно каталога `attachments`
+    path = Column(Text, primary_key=True)
+
+    # Ссылка, по которой файл был загружен
+    url = Column(Text, index=True)
+
+    size = Column(Integer, nullable=False)
+    sha256 = Column(Text, nullable=False)
+    etag = Column(Text)
+
+    # Время загрузки файла
+    downloaded = Column(DateTime, nullable=False)
+
+
+# Общий для всех переписок манифест переписок, сохраненных в удобном для чтения формате
+RenderBase = declarative_base()
+
+
+class Render(RenderBase):
+    __tablename__ = 'renders'
+
+    fmt = Column(Text, primary_key=True)
+    peer_id = Column(Integer, primary_key=True, autoincrement=False)
+
+    # Состояние БД переписки (см. `SyncInfo`), по которому она была сохранена
+    last_msg_id = Column(Integer)
+    msg_count = Column(Integer)
+    synced = Column(DateTime)
+
+    # Отпечаток версии VKMS и шаблонов (см. `saver.signature`)
+    signature = Column(Text, nullable=False)
+
+    # Путь к сохраненному файлу относительно каталога с результатом работы программы
+    path = Column(Text, nullable=False)
+
+
+# Настройки SQLite для массовой вставки (см. `connect`)
+_ingest_pragmas = (
+    # Размер страницы применяется только к новой БД, поэтому задается до включения WAL
+    'page_size = 8192',
+    'journal_mode = WAL',
+    # В режиме WAL при сбое теряются лишь последние транзакции, но не целостность БД
+    'synchronous = NORMAL',
+    # Размер кэша страниц (отрицательное значение - в КиБ)
+    'cache_size = -32768',
+    'temp_store = MEMORY'
+)
+
+
+def connect(path, base=Base, ingest=False, compress=False):
+    """
+    Открывает (и при необходимости создает) БД
+
+    Args:
+        path (pathlib.Path): Путь к БД
+        base: Декларативная база, таблицы которой нужно создать
+        ingest (bool): Настроить SQLite для массовой вставки (используется при загрузке
+            переписок): журнал WAL, менее частая синхронизация с диском и увеличенный кэш
+        compress (bool): Сжимать записываемые JSON-поля. Чтение прозрачно: сжатые и
+            несжатые значения читаются одинаково, независимо от этого параметра
+
+    Returns:
+        sqlalchemy.orm.Session: Сессия БД
+    """
+    engine = create_engine(
+        f'sqlite:///{path}',
+        future=True,
+        json_serializer=_dumps_zlib_v1 if compress else dumps,
+        json_deserializer=_loads
+    )
+
+    if ingest:
+        @event.listens_for(engine, 'connect')
+        def set_pragmas(dbapi_connection, connection_record):  # noqa: U100
+            cursor = dbapi_connection.cursor()
+
+            for pragma in _ingest_pragmas:
+                cursor.execute(f'PRAGMA {pragma}')
+
+            cursor.close()
+
+    base.metadata.create_all(engine)
+
+    if base is Base:
+        _migrate(engine)
+
     session = sessionmaker(bind=engine)()
 
     return session
+
+
+def insert(session, model, objs_json):
+    """
+    Быстро вставляет записи одним запросом `executemany`, не создавая ORM-объекты
+
+    Args:
+        session (sqlalchemy.orm.Session): Сессия БД
+        model: Модель (`Message` или `User`), записи которой вставляются
+        objs_json (list): Объекты, полученные от VK API
+    """
+    if objs_json:
+        session.execute(model.__table__.insert(), [model.values(json) for json in objs_json])
+
+
+def index_text(session, msgs_json):
+    """
+    Добавляет сообщения в полнотекстовый индекс `messages_fts`. Индексируется текст
+    самого сообщения, пересланных сообщений и ответа
+
+    Args:
+        session (sqlalchemy.orm.Session): Сессия БД (или соединение)
+        msgs_json (list): Объекты сообщений
+    """
+    rows = []
+
+    for msg_json in msgs_json:
+        texts = []
+
+        # Обход сообщения и всех вложенных в него в ширину
+        queue = deque([msg_json])
+
+        while queue:
+            msg = queue.popleft()
+
+            if msg.get('text'):
+                texts.append(msg['text'])
+
+            queue.extend(msg.get('fwd_messages', ()))
+
+            if 'reply_message' in msg:
+                queue.append(msg['reply_message'])
+
+        if texts:
+            rows.append({'id': msg_json['id'], 'text': '\n'.join(texts)})
+
+    if rows:
+        session.execute(text('INSERT INTO messages_fts (rowid, text) VALUES (:id, :text)'), rows)
+
+
+def search(session, query, limit):
+    """
+    Ищет сообщения по полнотекстовому индексу. Каждое слово запроса должно встречаться
+    в сообщении, слово, оканчивающееся на `*`, ищется как префикс
+
+    Args:
+        session (sqlalchemy.orm.Session): Сессия БД переписки
+        query (str): Поисковый запрос
+        limit (int): Максимальное кол-во результатов
+
+    Returns:
+        list: Найденные сообщения (идентификатор, дата, отправитель, фрагмент текста с
+            выделенными словами и релевантность - чем меньше, тем лучше) по убыванию
+            релевантности
+    """
+    # Экранируем слова, чтобы символы запроса не считались синтаксисом FTS5
+    match = ' '.join(
+        '"{}"{}'.format(word.rstrip('*').replace('"', '""'), '*' if word.endswith('*') else '')
+        for word in query.split() if word.rstrip('*')
+    )
+
+    if not match:
+        return []
+
+    return session.execute(text(
+        "SELECT m.id, m.date, m.from_id, snippet(messages_fts, 0, '[', ']', '...', 12), "
+        'bm25(messages_fts) AS rank '
+        'FROM messages_fts JOIN messages AS m ON m.id = messages_fts.rowid '
+        'WHERE messages_fts MATCH :match ORDER BY rank LIMIT :limit'
+    ).columns(date=DateTime), {'match': match, 'limit': limit}).all()
+
+
+def convert(path, compress):
+    """
+    Перезаписывает все JSON-поля БД переписки в сжатом или несжатом виде и освобождает
+    место, занятое старыми значениями
+
+    Args:
+        path (pathlib.Path): Путь к БД переписки
+        compress (bool): Сжимать ли JSON-поля
+    """
+    session = connect(path, compress=compress)
+
+    for table in Base.metadata.sorted_tables:
+        columns = [column for column in table.columns if isinstance(column.type, JSON)]
+
+        if not columns:
+            continue
+
+        update = table.update().where(table.c.id == bindparam('_id'))
+        last_id = None
+
+        # Перезаписываем порциями в порядке идентификаторов
+        while True:
+            query = select(table.c.id, *columns).order_by(table.c.id).limit(5000)
+
+            if last_id is not None:
+                query = query.where(table.c.id > last_id)
+
+            rows = session.execute(query).all()
+
+            if not rows:
+                break
+
+            session.execute(update, [
+                {'_id': row[0], **{column.name: value for column, value in zip(columns, row[1:])}}
+                for row in rows
+            ])
+            last_id = rows[-1][0]
+
+        session.commit()
+
+    session.execute(text('VACUUM'))
+
+    # Переносим журнал WAL в основной файл, чтобы размер БД на диске был окончательным
+    session.execute(text('PRAGMA wal_checkpoint(TRUNCATE)'))
+    session.close()
+    session.get_bind().dispose()
+
+
+def has_progress(path):
+    """
+    Проверяет, есть ли в БД переписки незавершенная загрузка. БД открывается без создания
+    таблиц и миграций, поэтому проверка быстрая даже для БД предыдущих версий
+
+    Args:
+        path (pathlib.Path): Путь к БД переписки
+
+    Returns:
+        bool: Есть ли контрольная точка загрузки
+    """
+    if not path.exists():
+        return False
+
+    engine = create_engine(f'sqlite:///{path}', future=True)
+
+    try:
+        with engine.connect() as conn:
+            return (
+                inspect(conn).has_table(Progress.__tablename__)
+                and conn.execute(select(Progress.id)).first() is not None
+            )
+
+    finally:
+        engine.dispose()
+
+
+def size(path):
+    """
+    Вычисляет размер БД на диске вместе с файлами журнала WAL
+
+    Args:
+        path (pathlib.Path): Путь к БД
+
+    Returns:
+        int: Размер в байтах
+    """
+    total = 0
+
+    for suffix in ('', '-wal', '-shm'):
+        file = path.with_name(path.name + suffix)
+
+        if file.exists():
+            total += file.stat().st_size
+
+    return total
+
+
+def _add_message_columns(conn):
+    # Добавляет в таблицу `messages` поля, извлекаемые из JSON, и заполняет их
+    table = Message.__table__
+    existing = {row[1] for row in conn.exec_driver_sql('PRAGMA table_info(messages)')}
+
+    for column in table.columns:
+        if column.name not in existing:
+            conn.exec_driver_sql(
+                f'ALTER TABLE messages ADD COLUMN {column.name} '
+                f'{column.type.compile(conn.dialect)}'
+            )
+
+    for index in table.indexes:
+        index.create(conn, checkfirst=True)
+
+    update = table.update().where(table.c.id == bindparam('_id'))
+    extracted = [name for name in table.columns.keys() if name not in ('id', 'json', 'date')]
+    filled = 0
+
+    # Заполняем поля порциями, чтобы не загружать всю переписку в память
+    while True:
+        rows = conn.execute(
+            select(table.c.id, table.c.json).where(table.c.from_id.is_(None)).limit(5000)
+        ).all()
+
+        if not rows:
+            break
+
+        updates = []
+
+        for id, json in rows:
+            values = Message.values(json)
+            updates.append({'_id': id, **{name: values[name] for name in extracted}})
+
+        conn.execute(update, updates)
+        filled += len(rows)
+
+    if filled:
+        log.info(f'Migrated {filled} messages')
+
+
+def _fill_sync_info(conn):
+    # Заполняет метаданные синхронизации по уже сохраненным сообщениям
+    peer_id = conn.execute(select(Peer.id)).scalar()
+
+    if peer_id is None or conn.execute(select(SyncInfo.id)).scalar() is not None:
+        return
+
+    last_msg = conn.execute(
+        select(Message.id, Message.date).order_by(Message.date.desc()).limit(1)
+    ).first()
+
+    conn.execute(SyncInfo.__table__.insert().values(
+        id=peer_id,
+        last_msg_id=last_msg and last_msg.id,
+        last_msg_date=last_msg and last_msg.date,
+        msg_count=conn.execute(select(func.count()).select_from(Message.__table__)).scalar()
+    ))
+
+
+def _create_fts(conn):
+    # Создает полнотекстовый индекс и добавляет в него уже сохраненные сообщения
+    conn.exec_driver_sql(
+        'CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts '
+        "USING fts5(text, tokenize='unicode61 remove_diacritics 2')"
+    )
+
+    table = Message.__table__
+    last_id = conn.exec_driver_sql('SELECT max(rowid) FROM messages_fts').scalar()
+
+    # Добавляем сообщения порциями, чтобы не загружать всю переписку в память
+    while True:
+        query = select(table.c.id, table.c.json).order_by(table.c.id).limit(5000)
+
+        if last_id is not None:
+            query = query.where(table.c.id > last_id)
+
+        rows = conn.execute(query).all()
+
+        if not rows:
+            break
+
+        index_text(conn, [json for _, json in rows])
+        last_id = rows[-1][0]
+
+        log.info(f'Indexed messages up to {last_id}')
+
+
+def _index_attachments(conn):
+    # Заполняет таблицу вложений по уже сохраненным сообщениям
+    from .attachments import class_to_name, index
+
+    table = Message.__table__
+    mask = sum(ATCH_FLAGS[cls.tp] for cls in class_to_name)
+    last_id = conn.execute(select(func.max(Attachment.msg_id))).scalar()
+
+    # Разбираем только сообщения со скачиваемыми вложениями (см. `atch_flags`)
+    while True:
+        query = select(table.c.id, table.c.json).where(
+            table.c.atch_flags.op('&')(mask) != 0
+        ).order_by(table.c.id).limit(5000)
+
+        if last_id is not None:
+            query = query.where(table.c.id > last_id)
+
+        rows = conn.execute(query).all()
+
+        if not rows:
+            break
+
+        index(conn, [json for _, json in rows])
+        last_id = rows[-1][0]
+
+        log.info(f'Indexed attachments up to message {last_id}')
+
+
+# Миграции схемы БД переписки. Кол-во примененных миграций хранится в `PRAGMA user_version`,
+# каждая миграция должна корректно работать и на уже обновленной схеме (новая БД создается
+# сразу с актуальной схемой). Миграция выполняется в одной транзакции с обновлением
+# `user_version`: если она прервется, ее изменения откатываются, и при следующем запуске
+# она выполняется заново целиком
+_migrations = (
+    _add_message_columns,
+    _fill_sync_info,
+    _create_fts,
+    _index_attachments
+)
+
+
+def _migrate(engine):
+    # Применяет к БД переписки недостающие миграции, каждую в отдельной транзакции, чтобы
+    # уже примененные миграции сохранялись, даже если следующая прервется
+    with engine.connect() as conn:
+        current = conn.exec_driver_sql('PRAGMA user_version').scalar()
+
+    for version, migration in enumerate(_migrations[current:], current + 1):
+        with engine.begin() as conn:
+            migration(conn)
+            conn.exec_driver_sql(f'PRAGMA user_version = {version}')
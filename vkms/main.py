@@ -30,6 +30,7 @@ def main():
 
     (args.out_dir / '.json').mkdir(parents=True, exist_ok=True)
     (args.out_dir / '.sqlite').mkdir(parents=True, exist_ok=True)
+    (args.out_dir / '.state').mkdir(parents=True, exist_ok=True)
 
     _setup_logging(args.out_dir, args.verbose)
     log.info(f'VKMS {__version__} started')
@@ -41,16 +42,36 @@ def main():
             args.include,
             args.exclude,
             args.token,
+            args.engine,
             args.threads,
+            args.rps,
+            args.execute,
+            args.profiles_ttl,
             args.max_msgs,
             args.append,
+            args.compress,
             args.export_json
         )
 
     elif args.action == 'parse':
-        actions.parse(args.out_dir, args.include, args.exclude, args.fmt)
+        actions.parse(args.out_dir, args.include, args.exclude, args.fmt, args.jobs, args.paginate)
+
+    elif args.action == 'search':
+        actions.search(args.out_dir, args.include, args.exclude, ' '.join(args.query), args.limit)
+
+    elif args.action == 'convert':
+        actions.convert(args.out_dir, args.include, args.exclude, not args.decompress)
 
     elif args.action == 'atch':
-        actions.atch(args.out_dir, args.include, args.exclude, args.threads, args.types)
+        actions.atch(
+            args.out_dir,
+            args.include,
+            args.exclude,
+            args.engine,
+            args.threads,
+            args.types,
+            args.verify,
+            args.dedup
+        )
 
     log.info('VKMS completed\n')
@@ -1,70 +1,196 @@
 import datetime
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections import deque
+from itertools import islice
 from re import sub
 
 from . import database as db
+from .api import submit
 from .attachments import gen_attachment
 from .utils import months
 
 
-def download(api, peer_id, nthreads, max_msgs, start_msg_id):
+def count(api, executor, peer_id):
+    """
+    Получает количество сообщений в переписке
+
+    Args:
+        api (vk.API): Объект, через который происходит обращение к методам VK API
+        executor (ThreadPoolExecutor): Пул потоков, в котором выполняются запросы к VK API
+        peer_id (int): Идентификатор переписки
+
+    Returns:
+        int: Количество сообщений
+    """
+    return executor.submit(api.messages.getHistory, count=1, peer_id=peer_id).result()['count']
+
+
+async def count_async(api, peer_id):
+    """
+    Асинхронный вариант `count`
+
+    Args:
+        api (aio.AsyncAPI): Объект, через который происходит обращение к методам VK API
+        peer_id (int): Идентификатор переписки
+
+    Returns:
+        int: Количество сообщений
+    """
+    return (await api.messages.getHistory(count=1, peer_id=peer_id))['count']
+
+
+def download(api, executor, peer_id, start_msg_id, offset, count, execute, window):
     """
     Загружает сообщения переписки. В начале идут старые сообщения, в конце - новые
 
+    Страницы возвращаются строго по порядку смещений. Одновременно загружается не более
+    `window` запросов, а следующий запрос отправляется только после того, как обработана
+    очередная страница, поэтому потребление памяти не зависит от размера переписки
+
     Args:
         api (vk.API): Объект, через который происходит обращение к методам VK API
+        executor (ThreadPoolExecutor): Пул потоков, в котором выполняются запросы к VK API
         peer_id (int): Идентификатор переписки, сообщения которой необходимо скачать
-        max_msgs (int): Кол-во сообщений, которое нужно сохранить (может быть меньше
-            заявленного, если переписка содержит меньше сообщений)
         start_msg_id (int): Идентификатор сообщения, после которого следует сохранять
-            сообщения (используется для дозаписи новых сообщений)
+            сообщения (используется для дозаписи новых сообщений). Если `None`, смещение
+            отсчитывается от самого старого сообщения переписки
+        offset (int): Смещение первого загружаемого сообщения
+        count (int): Кол-во сообщений, которое нужно загрузить, начиная со смещения
+        execute (bool): Упаковывать ли запросы в `execute` (до 25 запросов в одном)
+        window (int): Максимальное кол-во одновременно загружаемых запросов
 
     Yields:
-        list: Чанк загруженных сообщений, размер не превышает 5000
+        Tuple[int, list]: Кол-во обработанных смещений (с учетом текущей страницы) и
+            страница загруженных сообщений, размер которой не превышает 200. При дозаписи
+            загрузка завершается на первой неполной странице
     """
-    # Получаем количество сообщений в переписке, чтобы сформировать необходимый offset
-    res = api.messages.getHistory(count=1, peer_id=peer_id)
+    calls = _history_calls(peer_id, start_msg_id, offset, count)
+
+    # Очередь из отправленных запросов (параметры вызовов и задача) в порядке смещений
+    tasks = deque()
+
+    # При дозаписи новых сообщений обычно мало, поэтому сначала отправляется один запрос,
+    # а окно увеличивается вдвое после каждого запроса, все страницы которого полные
+    limit = 1 if start_msg_id else window
+
+    def fill():
+        while len(tasks) < limit:
+            chunk = list(islice(calls, 25 if execute else 1))
+
+            if not chunk:
+                break
+
+            tasks.append((chunk, submit(executor, api, 'messages.getHistory', chunk, execute)[0]))
+
     processed = 0
 
-    max_msgs = min(max_msgs, res['count'])
-
-    with ThreadPoolExecutor(nthreads, 'Thread-') as executor:
-        tasks = []
-
-        # Скачиваем, пока все сообщения не будут загружены
-        while processed < max_msgs:
-            if start_msg_id is None:
-                tasks.append(executor.submit(
-                    api.messages.getHistory,
-                    offset=res['count'] - min(max_msgs, res['count']) + processed,
-                    count=min(max_msgs - processed, 200),
-                    peer_id=peer_id,
-                    rev=1
-                ))
-
-            else:
-                tasks.append(executor.submit(
-                    api.messages.getHistory,
-                    offset=-(processed + min(max_msgs - processed, 200)),
-                    count=min(max_msgs - processed, 200),
-                    peer_id=peer_id,
-                    start_message_id=start_msg_id
-                ))
-
-            processed += 200
-
-            # Чтобы не нагружать память, возвращаем сообщения частями
-            if not processed % 5000:
-                yield (
-                    msg for future in as_completed(tasks)
-                    for msg in future.result()['items'][::-1 + (not start_msg_id) * 2]
-                )
-                tasks.clear()
-
-        yield (
-            msg for future in as_completed(tasks)
-            for msg in future.result()['items'][::-1 + (not start_msg_id) * 2]
-        )
+    try:
+        fill()
+
+        while tasks:
+            chunk, future = tasks.popleft()
+            pages = future.result()
+
+            # Освободившееся место в окне сразу занимаем следующим запросом
+            if limit == window:
+                fill()
+
+            for params, page in zip(chunk, pages):
+                processed += params['count']
+                yield processed, page['items'][::-1 + (not start_msg_id) * 2]
+
+                # При дозаписи неполная страница означает, что новых сообщений больше нет
+                if start_msg_id and len(page['items']) < params['count']:
+                    return
+
+            limit = min(limit * 2, window)
+            fill()
+
+    finally:
+        # Если загрузка прервана, отменяем еще не начатые запросы
+        for _, future in tasks:
+            future.cancel()
+
+
+async def download_async(api, peer_id, start_msg_id, offset, count, execute, window):
+    """
+    Асинхронный вариант `download`. Страницы так же возвращаются строго по порядку
+    смещений, а одновременно загружается не более `window` запросов
+
+    Args:
+        api (aio.AsyncAPI): Объект, через который происходит обращение к методам VK API
+        peer_id (int): Идентификатор переписки, сообщения которой необходимо скачать
+        start_msg_id (int): Идентификатор сообщения, после которого следует сохранять
+            сообщения. Если `None`, смещение отсчитывается от самого старого сообщения
+        offset (int): Смещение первого загружаемого сообщения
+        count (int): Кол-во сообщений, которое нужно загрузить, начиная со смещения
+        execute (bool): Упаковывать ли запросы в `execute` (до 25 запросов в одном)
+        window (int): Максимальное кол-во одновременно загружаемых запросов
+
+    Yields:
+        Tuple[int, list]: Кол-во обработанных смещений (с учетом текущей страницы) и
+            страница загруженных сообщений, размер которой не превышает 200
+    """
+    calls = _history_calls(peer_id, start_msg_id, offset, count)
+    tasks = deque()
+    limit = 1 if start_msg_id else window
+
+    def fill():
+        while len(tasks) < limit:
+            chunk = list(islice(calls, 25 if execute else 1))
+
+            if not chunk:
+                break
+
+            tasks.append((chunk, api.submit('messages.getHistory', chunk, execute)[0]))
+
+    processed = 0
+
+    try:
+        fill()
+
+        while tasks:
+            chunk, task = tasks.popleft()
+            pages = await task
+
+            if limit == window:
+                fill()
+
+            for params, page in zip(chunk, pages):
+                processed += params['count']
+                yield processed, page['items'][::-1 + (not start_msg_id) * 2]
+
+                # При дозаписи неполная страница означает, что новых сообщений больше нет
+                if start_msg_id and len(page['items']) < params['count']:
+                    return
+
+            limit = min(limit * 2, window)
+            fill()
+
+    finally:
+        for _, task in tasks:
+            task.cancel()
+
+
+def _history_calls(peer_id, start_msg_id, offset, count):
+    # Генерирует параметры запросов, каждый из которых загружает до 200 сообщений
+    for processed in range(0, count, 200):
+        page_count = min(count - processed, 200)
+
+        if start_msg_id is None:
+            yield {
+                'offset': offset + processed,
+                'count': page_count,
+                'peer_id': peer_id,
+                'rev': 1
+            }
+
+        else:
+            yield {
+                'offset': -(offset + processed + page_count),
+                'count': page_count,
+                'peer_id': peer_id,
+                'start_message_id': start_msg_id
+            }
 
 
 # Шаблоны текстов сервисных действий в формате тип-текст
@@ -230,12 +356,21 @@ class MessagesFactory:
         # Создаем и возвращаем новое сообщение
         return Message(msg_id, msg_json, self._usernames, self.create_message)
 
-    def parse(self):
+    def parse(self, first_id=None, last_id=None):
         """
-        Парсит все доступные в БД сообщения
+        Парсит все доступные в БД сообщения (или сообщения с идентификаторами из диапазона)
+
+        Args:
+            first_id (Union[int, None]): Идентификатор первого сообщения диапазона
+            last_id (Union[int, None]): Идентификатор последнего сообщения диапазона
 
         Yields:
             Message: текущий объект сообщения
         """
-        for msg_json, in self._session.query(db.Message.json).yield_per(5000):
+        query = self._session.query(db.Message.json)
+
+        if first_id is not None:
+            query = query.filter(db.Message.id.between(first_id, last_id)).order_by(db.Message.id)
+
+        for msg_json, in query.yield_per(5000):
             yield self.create_message(msg_json)
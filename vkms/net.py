@@ -0,0 +1,33 @@
+from requests import Session
+from requests.adapters import HTTPAdapter
+
+# Кол-во хостов, пулы соединений с которыми хранятся одновременно (вложения
+# раздаются с множества серверов VK)
+_max_hosts = 32
+
+
+def create_session(pool_size):
+    """
+    Создает HTTP-сессию, которую могут одновременно использовать несколько потоков.
+    Соединения переиспользуются (keep-alive), поэтому на каждый запрос не тратится
+    время на установку TCP и TLS соединения
+
+    Args:
+        pool_size (int): Максимальное кол-во соединений с одним хостом (обычно
+            совпадает с кол-вом потоков). Если все соединения заняты, поток ждет
+            освобождения одного из них, а не открывает новое
+
+    Returns:
+        requests.Session: HTTP-сессия с пулом соединений
+    """
+    adapter = HTTPAdapter(
+        pool_connections=_max_hosts,
+        pool_maxsize=pool_size,
+        pool_block=True
+    )
+
+    session = Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    return session
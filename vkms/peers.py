@@ -1,30 +1,64 @@
+from collections import namedtuple
 from json import dumps
 
+from sqlalchemy import Integer, cast, func, select
+
 from . import database as db
 from . import messages, users
 
 
 def download(api):
     """
-    Загружает базовую информацию о всех переписках пользователя
+    Загружает базовую информацию о всех переписках пользователя. Вместе с переписками
+    VK API возвращает их участников (пользователей и группы), которые тоже сохраняются
 
     Args:
         api (vk.API): Объект, через который происходит обращение к
             методам VK API
+
+    Returns:
+        Tuple[list, list]: Переписки и объекты их участников (пользователей и групп)
     """
     # Получаем часть переписок
-    res = api.messages.getConversations(count=200)
+    res = api.messages.getConversations(count=200, extended=1)
     peers = [item['conversation'] for item in res['items']]
+    profiles = res.get('profiles', []) + res.get('groups', [])
 
     processed = len(peers)
 
     # Повторяем действия выше, пока все переписки не будут загружены
     while processed < res['count']:
-        res = api.messages.getConversations(offset=processed, count=200)
+        res = api.messages.getConversations(offset=processed, count=200, extended=1)
+        peers += [item['conversation'] for item in res['items']]
+        profiles += res.get('profiles', []) + res.get('groups', [])
+        processed += 200
+
+    return peers, profiles
+
+
+async def download_async(api):
+    """
+    Асинхронный вариант `download`
+
+    Args:
+        api (aio.AsyncAPI): Объект, через который происходит обращение к
+            методам VK API
+
+    Returns:
+        Tuple[list, list]: Переписки и объекты их участников (пользователей и групп)
+    """
+    peers = []
+    profiles = []
+    processed = 0
+
+    while True:
+        res = await api.messages.getConversations(offset=processed, count=200, extended=1)
         peers += [item['conversation'] for item in res['items']]
+        profiles += res.get('profiles', []) + res.get('groups', [])
         processed += 200
 
-    return peers
+        if processed >= res['count']:
+            return peers, profiles
 
 
 def export_json(out_dir, session):
@@ -57,6 +91,23 @@ def export_json(out_dir, session):
             print(dumps(user_json), file=file)
 
 
+def get_title(info, usernames):
+    """
+    Возвращает название переписки
+
+    Args:
+        info (dict): Информация о переписке
+        usernames (dict): Словарь для получения имени пользователя по его ID
+
+    Returns:
+        str: Название беседы или имя собеседника
+    """
+    if info['peer']['type'] == 'chat':
+        return info['chat_settings']['title']
+
+    return usernames[info['peer']['id']]
+
+
 class Peer:
     """
     Класс для представления всей переписки пользователя из JSON
@@ -68,6 +119,8 @@ class Peer:
     """
 
     def __init__(self, session):
+        self._session = session
+
         # Загружаем и сохраняем информацию о переписке из JSON
         self.account, self.info = session.query(db.Peer.account, db.Peer.info).one()
 
@@ -75,10 +128,54 @@ class Peer:
         usernames[0] = self.account
 
         # Парсим все сообщения переписки
-        self.msgs = messages.MessagesFactory(session, usernames).parse()
+        self._factory = messages.MessagesFactory(session, usernames)
+        self.msgs = self._factory.parse()
 
         # Сохраняем название переписки
-        if self.info['peer']['type'] == 'chat':
-            self.title = self.info['chat_settings']['title']
+        self.title = get_title(self.info, usernames)
+
+    def get_pages(self, by):
+        """
+        Разбивает переписку на страницы (по порядку сообщений)
+
+        Args:
+            by (Union[str, int]): `month` - по месяцам, число - по столько сообщений
+
+        Returns:
+            List[Page]: Страницы переписки
+        """
+        table = db.Message.__table__
+
+        if by == 'month':
+            query = select(table.c.id, table.c.date, func.strftime('%Y-%m', table.c.date))
         else:
-            self.title = usernames[self.info['peer']['id']]
+            number = func.row_number().over(order_by=table.c.id) - 1
+            query = select(table.c.id, table.c.date, cast(number / by, Integer))
+
+        # Границы каждой страницы
+        sub = query.subquery()
+        first_id = func.min(sub.c.id)
+
+        query = select(
+            first_id, func.max(sub.c.id), func.count(), func.min(sub.c.date), func.max(sub.c.date)
+        )
+        query = query.group_by(sub.columns[2]).order_by(first_id)
+
+        return [Page(*row) for row in self._session.execute(query)]
+
+    def get_msgs(self, page):
+        """
+        Парсит сообщения страницы переписки
+
+        Args:
+            page (Page): Страница переписки
+
+        Yields:
+            messages.Message: Сообщения страницы
+        """
+        return self._factory.parse(page.first_id, page.last_id)
+
+
+# Страница переписки: диапазон идентификаторов сообщений, их количество и даты первого
+# и последнего сообщений
+Page = namedtuple('Page', ('first_id', 'last_id', 'count', 'first_date', 'last_date'))
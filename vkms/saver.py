@@ -1,5 +1,7 @@
+import hashlib
 import os
 import re
+from bisect import bisect_right
 from io import StringIO
 from pathlib import Path
 
@@ -8,8 +10,10 @@ from markupsafe import Markup, escape
 from minify_html import minify
 from pathvalidate import sanitize_filename
 
+from . import __version__
 
-def save(out_dir, fmt, peer):
+
+def save(out_dir, fmt, peer, paginate=None):
     """
     Конвертирует и сохраняет сообщения в удобном для чтения формате
 
@@ -18,8 +22,36 @@ def save(out_dir, fmt, peer):
             результат работы программы
         fmt (str): Формат, в котором нужно сохранить переписку
         peer (peers.Peer): Объект переписки
+        paginate (Union[str, int, None]): Разбиение переписки на страницы (только для
+            формата HTML, см. `save_html`)
+
+    Returns:
+        pathlib.Path: Путь к сохраненному файлу (при разбиении на страницы - к оглавлению)
+    """
+    if fmt == 'html':
+        return save_html(out_dir, peer, paginate)
+
+    return globals()['save_' + fmt](out_dir, peer)
+
+
+def signature(fmt, paginate=None):
     """
-    globals()['save_' + fmt](out_dir, peer)
+    Вычисляет отпечаток версии VKMS и шаблонов. Если он изменился, переписки нужно
+    сохранить заново, даже если их сообщения остались прежними
+
+    Args:
+        fmt (str): Формат, в котором сохраняются переписки
+        paginate (Union[str, int, None]): Разбиение переписки на страницы
+
+    Returns:
+        str: Отпечаток (SHA-256)
+    """
+    digest = hashlib.sha256(f'{__version__}:{fmt}:{paginate}'.encode())
+
+    for path in sorted((Path(__file__).parent / 'templates').iterdir()):
+        digest.update(path.read_bytes())
+
+    return digest.hexdigest()
 
 
 def save_txt(out_dir, peer):
@@ -39,6 +71,8 @@ def save_txt(out_dir, peer):
     with open(path, 'w', encoding='utf-8') as file:
         _convert_txt_msgs(peer.msgs, peer.account['id'], file)
 
+    return path
+
 
 def _convert_txt_msgs(msgs, account_id, file=None):
     prev_msg = None
@@ -212,37 +246,165 @@ def _jinja_filter_with_mention(ctx, value):
     return result
 
 
-def save_html(out_dir, peer):
+# Папка с общими для всех переписок формата HTML стилями и скриптами
+_assets_dir = 'dialogs/html/assets'
+
+
+def save_assets(out_dir):
+    """
+    Сохраняет стили и скрипты, общие для всех переписок формата HTML. Они сжимаются
+    один раз за запуск, а страницы переписок только ссылаются на них
+
+    Args:
+        out_dir (str): Абсолютный путь к каталогу, в котором находится
+            результат работы программы
+    """
+    templates_dir = Path(__file__).parent.resolve() / 'templates'
+
+    assets_dir = out_dir / _assets_dir
+    assets_dir.mkdir(parents=True, exist_ok=True)
+
+    # minify-html сжимает CSS и JS только внутри HTML-документа, поэтому оборачиваем их
+    # в соответствующий тег, а после сжатия отбрасываем его
+    for name, tag in (('style.css', 'style'), ('script.js', 'script')):
+        source = (templates_dir / name).read_text(encoding='utf-8')
+        minified = _minify(f'<{tag}>{source}</{tag}>')
+
+        (assets_dir / name).write_text(minified[len(tag) + 2:-len(tag) - 3], encoding='utf-8')
+
+
+def save_html(out_dir, peer, paginate=None):
     """
     Сохраняет переписку в формате HTML. Верстка написана с нуля и была максимально
     приближена к версии VK на Android. В качестве бэкграунда использован шаблонизатор
     Jinja2
-    """
-    (out_dir / 'dialogs/html').mkdir(parents=True, exist_ok=True)
 
-    path = out_dir / 'dialogs/html/{title}_{peer_id}.html'.format(
+    Большую переписку можно разбить на страницы: тогда она сохраняется в отдельную
+    папку, в которой находятся страницы и оглавление `index.html`
+
+    Args:
+        paginate (Union[str, int, None]): `month` - разбить переписку на страницы по
+            месяцам, число - по столько сообщений. Если `None`, переписка сохраняется
+            в один файл
+    """
+    name = '{title}_{peer_id}'.format(
         title=sanitize_filename(peer.title, replacement_text='_'),
         peer_id=peer.info['peer']['id']
     )
 
+    html_dir = out_dir / 'dialogs/html'
+
+    if paginate:
+        html_dir /= name
+
+    html_dir.mkdir(parents=True, exist_ok=True)
+
     base_dir = Path(__file__).parent.resolve()
 
     # Инициализируем шаблонизатор
     env = Environment(loader=FileSystemLoader(base_dir / 'templates'), autoescape=True)
 
     def _jinja_filter_relpath(path):
-        return os.path.relpath(path, start=out_dir / 'dialogs/html')
+        return os.path.relpath(path, start=html_dir)
+
+    def _jinja_filter_asset(name):
+        # Относительная ссылка на общий файл стилей или скриптов (см. `save_assets`)
+        return Path(_jinja_filter_relpath(out_dir / _assets_dir / name)).as_posix()
 
     env.filters['relpath'] = _jinja_filter_relpath
+    env.filters['asset'] = _jinja_filter_asset
     env.filters['nl2br'] = _jinja_filter_nl2br
     env.filters['with_mention'] = _jinja_filter_with_mention
 
     template = env.get_template('peer.html')
 
-    # Сохраняем конвертированный текст (предварительно сжав HTML)
+    if not paginate:
+        path = html_dir / f'{name}.html'
+        _render(path, template, out_dir=out_dir, peer=peer, msgs=peer.msgs)
+
+        return path
+
+    pages = [
+        (f'{page.first_date:%Y-%m}.html' if paginate == 'month' else f'{num}.html', page)
+        for num, page in enumerate(peer.get_pages(paginate), 1)
+    ]
+    first_ids = [page.first_id for _, page in pages]
+
+    def page_of(msg_id):
+        # Имя файла страницы, на которой находится сообщение (пустая строка, если
+        # сообщения нет в переписке)
+        num = bisect_right(first_ids, msg_id) - 1
+
+        if num < 0 or msg_id > pages[num][1].last_id:
+            return ''
+
+        return pages[num][0]
+
+    # Удаляем страницы, оставшиеся от прошлого сохранения с другим разбиением
+    filenames = {filename for filename, _ in pages} | {'index.html'}
+
+    for path in html_dir.glob('*.html'):
+        if path.name not in filenames:
+            path.unlink()
+
+    for num, (filename, page) in enumerate(pages):
+        _render(
+            html_dir / filename, template,
+            out_dir=out_dir,
+            peer=peer,
+            msgs=peer.get_msgs(page),
+            page_of=page_of,
+            pages=pages,
+            page_num=num
+        )
+
+    path = html_dir / 'index.html'
+    _render(path, env.get_template('index.html'), peer=peer, pages=pages)
+
+    return path
+
+
+def _render(path, template, **context):
+    # Сохраняет документ по мере генерации, сжимая его частями, поэтому потребление
+    # памяти не зависит от размера переписки
     with open(path, 'w', encoding='utf-8') as file:
-        file.write(minify(
-            template.render(out_dir=out_dir, peer=peer),
-            minify_js=True,
-            minify_css=True
-        ))
+        _write_minified(file, template.generate(chunk_end=Markup(_chunk_end), **context))
+
+
+# Метка конца сообщения в HTML-документе. Между метками находятся законченные элементы,
+# поэтому документ можно сжимать по частям, разделяя его по ним
+_chunk_end = '<!--vkms-chunk-end-->'
+
+# Закрывающие теги в начале последней части документа (их нельзя сжимать отдельно)
+_closing_tags_re = re.compile(r'\s*(?:</\w+>\s*)*')
+
+
+def _write_minified(file, chunks, buffer_size=1 << 20):
+    # Записывает сжатый HTML-документ, сгенерированный частями. Сжимаются части
+    # документа размером примерно `buffer_size` символов, разделенные по `_chunk_end`
+    buffer = []
+    size = 0
+
+    for chunk in chunks:
+        buffer.append(chunk)
+        size += len(chunk)
+
+        if size >= buffer_size:
+            head, sep, rest = ''.join(buffer).rpartition(_chunk_end)
+
+            if sep:
+                file.write(_minify(head))
+                buffer, size = [rest], len(rest)
+
+    # После последнего сообщения закрываются элементы, открытые в начале документа.
+    # При сжатии они были бы отброшены, поэтому записываем их как есть
+    head, _, tail = ''.join(buffer).rpartition(_chunk_end)
+    closing_tags = _closing_tags_re.match(tail).group()
+
+    file.write(_minify(head))
+    file.write(''.join(closing_tags.split()))
+    file.write(_minify(tail[len(closing_tags):]))
+
+
+def _minify(html):
+    return minify(html, minify_js=True, minify_css=True)
@@ -0,0 +1,103 @@
+function scroll_to_message(msg_id) {
+  window.scrollBy({
+    top: document.getElementById(msg_id).getBoundingClientRect().top,
+    left: 0,
+    behavior: 'smooth'
+  });
+}
+
+var cur_player = null;
+var playerProgress = document.getElementById("player-bar-progress");
+var playerBtn = document.getElementById("player-bar-btn");
+
+function play_player(player) {
+  let [ audio, btn ] = player.children;
+
+  if (!audio.readyState) {
+    alert('Не удалось воспроизвести голосовое сообщение');
+    return;
+  }
+
+  document.getElementById("player-bar").style.display = "flex";
+
+  if (cur_player !== player) {
+    if (cur_player)
+      pause_player(cur_player, true);
+
+    playerProgress.style.width = 0;
+    document.getElementById("player-audio-duration").textContent =
+      (Math.round(audio.duration) / 60 | 0).toString() + ':' +
+      (Math.round(audio.duration) % 60).toString().padStart(2, '0');
+
+    document.getElementById("player-bar-username").textContent =
+      document.getElementById(player.id.replace("player-", "")).
+      querySelector(".msg-username").textContent;
+  }
+  else if (!audio.paused) {
+    pause_player(player);
+    return;
+  }
+
+  playerBtn.classList.remove("player-btn-play");
+  playerBtn.classList.add("player-btn-pause");
+
+  cur_player = player;
+
+  btn.classList.remove("player-btn-play");
+  btn.classList.add("player-btn-pause");
+  audio.play();
+
+  let interval = setInterval(() => {
+    if (audio.paused || audio.currentTime == audio.duration)
+      clearInterval(interval);
+
+    playerProgress.style.width = `${audio.currentTime / audio.duration * 100}%`
+  }, 200);
+}
+
+function pause_player(player, reset=false) {
+  playerBtn.classList.remove("player-btn-pause");
+  playerBtn.classList.add("player-btn-play");
+
+  let [ audio, btn ] = player.children;
+
+  btn.classList.add("player-btn-play");
+  btn.classList.remove("player-btn-pause");
+  audio.pause();
+
+  if (reset) audio.currentTime = 0;
+}
+
+const themes = {
+  light: {
+    "--color-bg": "#fff",
+    "--color-bg-msg-in": "#ecedf1",
+    "--color-bg-msg-out": "#cce4ff",
+    "--color-text": "#000",
+    "--color-player-bar": "#000"
+  },
+  dark: {
+    "--color-bg": "#191919",
+    "--color-bg-msg-out": "#454648",
+    "--color-bg-msg-in": "#2c2d2f",
+    "--color-text": "#fff",
+    "--color-player-bar": "#9198a2"
+  }
+};
+var cur_theme = "light";
+
+function switch_theme() {
+  let root = document.documentElement;
+
+  const themes_keys = Object.keys(themes);
+  cur_theme = themes_keys[(themes_keys.indexOf(cur_theme) + 1) % themes_keys.length];;
+
+  for (const [ name, value ] of Object.entries(themes[cur_theme])) {
+    console.log(name, value);
+    root.style.setProperty(name, value);
+  }
+}
+document.addEventListener("keydown", function (e) {
+  if (e.keyCode == 84)
+    switch_theme();
+});
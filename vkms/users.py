@@ -1,8 +1,12 @@
+import asyncio
+import datetime
 from collections import deque
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import as_completed
 from itertools import chain
+from threading import Lock
 
 from . import database as db
+from .api import submit
 from .utils import chunks
 
 
@@ -38,47 +42,134 @@ def collect(msg, user_ids, group_ids):
             queue.append(msg['reply_message'])
 
 
-def download(api, nthreads, user_ids, group_ids):
+def download(api, executor, user_ids, group_ids, execute):
     """
     Загружает имена участников переписки
 
     Args:
         api (vk.API): Объект, через который происходит обращение к методам VK API
+        executor (ThreadPoolExecutor): Пул потоков, в котором выполняются запросы к VK API
         user_ids (set): Идентификаторы участников (пользователей) беседы
         group_ids (set): Идентификаторы участников (групп) беседы
+        execute (bool): Упаковывать ли запросы в `execute` (до 25 запросов в одном)
 
     Yields:
-        list: Чанк загруженных пользователей, размер не превышает 5000
+        list: Чанк загруженных пользователей, размер не превышает 5000 (25000
+            в режиме `execute`)
     """
-    with ThreadPoolExecutor(nthreads, 'Thread-') as executor:
-        tasks = []
+    # Один запрос загружает до 1000 пользователей, в режиме `execute` один чанк
+    # загружается одним запросом
+    size = 25000 if execute else 5000
+
+    # Сначала загружаем пользователей
+    for chunk in chunks(user_ids, size):
+        tasks = submit(executor, api, 'users.get', [
+            {'user_ids': ','.join(map(str, subchunk))}
+            for subchunk in chunks(chunk, 1000)
+        ], execute)
+
+        yield list(chain.from_iterable(
+            users for future in as_completed(tasks)
+            for users in future.result()
+        ))
+
+    # Затем загружаем сообщества
+    for chunk in chunks(group_ids, size):
+        tasks = submit(executor, api, 'groups.getById', [
+            {'group_ids': ','.join(map(str, subchunk))}
+            for subchunk in chunks(chunk, 1000)
+        ], execute)
+
+        yield list(chain.from_iterable(
+            groups for future in as_completed(tasks)
+            for groups in future.result()
+        ))
+
+
+async def download_async(api, user_ids, group_ids, execute):
+    """
+    Асинхронный вариант `download`
+
+    Args:
+        api (aio.AsyncAPI): Объект, через который происходит обращение к методам VK API
+        user_ids (set): Идентификаторы участников (пользователей) беседы
+        group_ids (set): Идентификаторы участников (групп) беседы
+        execute (bool): Упаковывать ли запросы в `execute` (до 25 запросов в одном)
 
-        # Сначала загружаем пользователей
-        for chunk in chunks(user_ids, 5000):
-            for subchunk in chunks(chunk, 1000):
-                tasks.append(executor.submit(
-                    api.users.get,
-                    user_ids=','.join(map(str, subchunk))
-                ))
+    Yields:
+        list: Чанк загруженных пользователей, размер не превышает 5000 (25000
+            в режиме `execute`)
+    """
+    size = 25000 if execute else 5000
+
+    for method, key, ids in (
+        ('users.get', 'user_ids', user_ids),
+        ('groups.getById', 'group_ids', group_ids)
+    ):
+        for chunk in chunks(ids, size):
+            tasks = api.submit(method, [
+                {key: ','.join(map(str, subchunk))}
+                for subchunk in chunks(chunk, 1000)
+            ], execute)
 
             yield list(chain.from_iterable(
-                future.result()
-                for future in as_completed(tasks)
+                users for results in await asyncio.gather(*tasks)
+                for users in results
             ))
-            tasks.clear()
 
-        # Затем загружаем сообщества
-        for chunk in chunks(group_ids, 5000):
-            for subchunk in chunks(chunk, 1000):
-                tasks.append(executor.submit(
-                    api.groups.getById,
-                    group_ids=','.join(map(str, subchunk))
-                ))
 
-            yield list(chain.from_iterable(
-                future.result()
-                for future in as_completed(tasks)
-            ))
+class Cache:
+    """
+    Общий для всех переписок кэш пользователей и групп. Позволяет не загружать заново
+    одних и тех же участников для каждой переписки. Используется несколькими потоками
+
+    Информация, сохраненная во время текущего запуска, всегда считается актуальной
+
+    Args:
+        path (pathlib.Path): Путь к БД кэша
+        ttl (float): Время (в днях), в течение которого информация считается актуальной
+    """
+
+    def __init__(self, path, ttl):
+        self._session = db.connect(path, db.CacheBase)
+        self._lock = Lock()
+        self.expires = datetime.datetime.now() - datetime.timedelta(days=ttl)
+
+    def get(self, ids):
+        """
+        Возвращает актуальную информацию о пользователях и группах из кэша
+
+        Args:
+            ids (set): Идентификаторы пользователей (> 0) и групп (< 0)
+
+        Returns:
+            list: Объекты найденных пользователей и групп
+        """
+        with self._lock:
+            return [
+                user_json
+                for chunk in chunks(ids, 500)
+                for user_json, in self._session.query(db.CachedUser.json).filter(
+                    db.CachedUser.id.in_(chunk),
+                    db.CachedUser.updated >= self.expires
+                )
+            ]
+
+    def put(self, users_json):
+        """
+        Сохраняет загруженных пользователей и группы в кэш
+
+        Args:
+            users_json (list): Объекты пользователей и групп, полученные от VK API
+        """
+        now = datetime.datetime.now()
+
+        with self._lock:
+            for user_json in users_json:
+                user = db.User(user_json)
+                self._session.merge(db.CachedUser(id=user.id, json=user_json, updated=now))
+
+            self._session.commit()
 
 
 def parse(session):